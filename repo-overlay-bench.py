@@ -0,0 +1,226 @@
+import argparse
+import imp
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pygit2
+
+parser = argparse.ArgumentParser(description='time the repo-overlay.py snapshot pipeline on a generated forest')
+parser.add_argument('--repos', type=int, default=50)
+parser.add_argument('--files', type=int, default=200)
+parser.add_argument('--depth', type=int, default=3)
+parser.add_argument('--history', type=int, default=10)
+parser.add_argument('--nested', type=int, default=5)
+parser.add_argument('--modified', type=int, default=2)
+parser.add_argument('--seed', type=int, default=0)
+parser.add_argument('--repeat', type=int, default=1)
+parser.add_argument('--jobs', type=int)
+parser.add_argument('--backend', choices=['thread', 'process'], default='thread')
+parser.add_argument('--dir')
+parser.add_argument('--keep', action='store_true')
+parser.add_argument('--output', default='repo-overlay-bench.json')
+
+args = parser.parse_args()
+
+overlay_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "repo-overlay.py")
+
+start_time = 1500000000
+day = 86400
+
+def signature(when):
+    return pygit2.Signature("bench", "bench@localhost", when, 0)
+
+def file_path(index, depth):
+    components = []
+    for level in range(depth):
+        components.append("d%d" % ((index >> level) % 4))
+    components.append("f%d.txt" % index)
+    return "/".join(components)
+
+def write_file(path, data):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+
+def commit_worktree(repo, message, when):
+    repo.index.add_all()
+    repo.index.write()
+    tree = repo.index.write_tree()
+    parents = []
+    if not repo.head_is_unborn:
+        parents = [repo.head.target]
+    return repo.create_commit("HEAD", signature(when), signature(when), message, tree, parents)
+
+def make_repository(path, rng):
+    repo = pygit2.init_repository(path)
+    for index in range(args.files):
+        write_file(os.path.join(path, file_path(index, args.depth)), "%s %d\n" % (path, index))
+    commit_worktree(repo, "initial", start_time)
+
+    for step in range(1, args.history):
+        for index in rng.sample(range(args.files), max(args.files // 10, 1)):
+            write_file(os.path.join(path, file_path(index, args.depth)), "%s %d %d\n" % (path, index, step))
+        commit_worktree(repo, "step %d" % step, start_time + step * day)
+
+    for index in rng.sample(range(args.files), min(args.modified, args.files)):
+        write_file(os.path.join(path, file_path(index, args.depth)), "modified\n")
+
+def make_forest(src, rng):
+    paths = []
+    for index in range(args.repos - args.nested):
+        paths.append("group%d/repo%d" % (index % 8, index))
+    for index in range(args.nested):
+        paths.append(paths[index % len(paths)] + "/nested%d" % index)
+
+    for path in paths:
+        make_repository(os.path.join(src, path), rng)
+
+    projects = []
+    for path in paths:
+        projects.append('  <project path="%s" name="bench/%s" />\n' % (path, path))
+    manifest = ('<?xml version="1.0" encoding="UTF-8"?>\n<manifest>\n' +
+                '  <remote name="origin" fetch="https://example.com/" />\n' +
+                '  <default revision="master" remote="origin" />\n' +
+                "".join(projects) + '</manifest>\n')
+
+    os.makedirs(os.path.join(src, ".repo", "local_manifests"))
+    for (path, name, data) in ((".repo/manifests", "default.xml", manifest),
+                               (".repo/repo", "main.py", "")):
+        repo = pygit2.init_repository(os.path.join(src, path))
+        write_file(os.path.join(src, path, name), data)
+        commit_worktree(repo, path, start_time)
+
+    return paths
+
+def load_overlay(src, out):
+    argv = [sys.argv[0], "--out", out, "--backend", args.backend]
+    if args.jobs is not None:
+        argv += ["--jobs", str(args.jobs)]
+    saved = sys.argv
+    sys.argv = argv
+    os.chdir(src)
+    try:
+        return imp.load_source("repo_overlay", overlay_path)
+    finally:
+        sys.argv = saved
+
+class Timer:
+    def phase(self, name, fn, *fargs):
+        start = time.time()
+        res = fn(*fargs)
+        self.phases[name] = self.phases.get(name, 0.0) + time.time() - start
+        return res
+
+    def __init__(self):
+        self.phases = {}
+
+def run_pipeline(ro, out, date):
+    timer = Timer()
+    shutil.rmtree(out, ignore_errors=True)
+    os.makedirs(out)
+    ro.created_dirs.clear()
+    ro.manifest_reader = None
+    ro.date_indexes.clear()
+    ro.pygit2_repositories.clear()
+
+    timer.phase("setup_repo_links", ro.setup_repo_links)
+    ro.manifest_reader = None
+    shutil.rmtree(os.path.join(out, "manifest-cache"), ignore_errors=True)
+    ro.forget_paths(os.path.join(out, "manifest-cache"))
+
+    def manifest():
+        manifests = ro.pygit2_repository(os.path.join(ro.xxxpwd, ".repo", "manifests"))
+        version = ro.date_index(manifests, ".repo/manifests").lookup(date)
+        return ro.ManifestData(version=version, date=date)
+    mdata = timer.phase("ManifestData", manifest)
+    dirstate = ro.DirState(mdata)
+
+    changed = {}
+    for repo in mdata.repos:
+        changed[repo] = timer.phase("find_changed", mdata.repos[repo].find_changed, dirstate)
+    def store_changed():
+        for repo in changed:
+            for path, itemtype in changed[repo]:
+                dirstate.store_item(path, ro.Item(path, itemtype=itemtype, changed=1))
+    timer.phase("store_item", store_changed)
+
+    types = {}
+    for repo in mdata.repos:
+        types[repo] = timer.phase("find_siblings_and_types",
+                                  mdata.repos[repo].find_siblings_and_types, dirstate, repo)
+    def store_types():
+        for repo in types:
+            for path, itemtype in types[repo]:
+                dirstate.store_item(path, ro.Item(path, itemtype=itemtype))
+    timer.phase("store_item", store_types)
+
+    timer.phase("create_directory", dirstate.create_directory, os.path.join(out, "head-py"))
+
+    items = len(list(dirstate.items.walk()))
+
+    shutil.rmtree(os.path.join(out, "head-py"))
+    ro.created_dirs.clear()
+    ro.pygit2_repositories.clear()
+    dirstate = ro.DirState(manifest())
+    timer.phase("snapshot", dirstate.snapshot, os.path.join(out, "head-py"))
+
+    return (timer.phases, items)
+
+def main():
+    rng = random.Random(args.seed)
+    output = os.path.abspath(args.output)
+    workdir = args.dir
+    if workdir is None:
+        workdir = tempfile.mkdtemp(prefix="repo-overlay-bench.")
+    src = os.path.join(workdir, "src")
+    out = os.path.join(workdir, "out")
+
+    start = time.time()
+    make_forest(src, rng)
+    generate = time.time() - start
+
+    ro = load_overlay(src, out)
+    date = start_time + args.history * day
+
+    runs = []
+    items = 0
+    try:
+        for count in range(args.repeat):
+            (phases, items) = run_pipeline(ro, out, date)
+            runs.append(phases)
+    finally:
+        ro.git_sessions.close()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "parameters": {
+            "repos": args.repos,
+            "files": args.files,
+            "depth": args.depth,
+            "history": args.history,
+            "nested": args.nested,
+            "modified": args.modified,
+            "seed": args.seed,
+            "jobs": ro.args.jobs,
+            "backend": args.backend,
+        },
+        "items": items,
+        "generate": generate,
+        "runs": runs,
+        "best": dict((name, min(run[name] for run in runs)) for name in runs[0]),
+    }
+
+    f = open(output, 'w')
+    json.dump(result, f, indent=2, sort_keys=True)
+    f.write("\n")
+    f.close()
+
+main()
@@ -6,12 +6,43 @@ import shutil
 import threading
 import Queue
 import signal
+import sys
+import multiprocessing
+import traceback
+import atexit
+import bisect
+import pickle
+import hashlib
+import time
+import struct
+import select
+import ctypes
+import ctypes.util
+import json
+import heapq
+import platform
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+try:
+    from urlparse import urljoin
+except ImportError:
+    from urllib.parse import urljoin
 
+from xml.etree import ElementTree
 from string import hexdigits
-from collections import deque
+from fnmatch import fnmatchcase
+from collections import deque, OrderedDict
 from stat import *
 
 parser = argparse.ArgumentParser(description='')
+parser.add_argument('command', nargs='?', choices=['snapshot', 'log', 'diff'], default='snapshot')
 
 parser.add_argument('--hardlink', action='store_true')
 parser.add_argument('--out')
@@ -21,46 +52,882 @@ parser.add_argument('--new-symlinks', action='store_true')
 parser.add_argument('--apply')
 parser.add_argument('--apply-repo')
 parser.add_argument('--apply-use-manifest')
+parser.add_argument('--git-sessions', type=int, default=64)
+parser.add_argument('--incremental', action='store_true')
+parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count() * 4)
+parser.add_argument('--backend', choices=['thread', 'process'], default='thread')
+parser.add_argument('--stream', action='store_true')
+parser.add_argument('--dry-run', action='store_true')
+parser.add_argument('--watch', action='store_true')
+parser.add_argument('--watch-delay', type=float, default=0.5)
+parser.add_argument('--dates', nargs='+')
+parser.add_argument('--date-step', type=int)
+parser.add_argument('--trace', action='store_true')
+parser.add_argument('--trace-json')
+parser.add_argument('--no-version-files', action='store_false', dest='version_files')
+parser.add_argument('--git-out')
+parser.add_argument('--git-ref', default='refs/heads/overlay')
+parser.add_argument('--since')
+parser.add_argument('--patch', action='store_true')
+parser.add_argument('--include', action='append', dest='patterns', type=lambda pattern: ("+", pattern))
+parser.add_argument('--exclude', action='append', dest='patterns', type=lambda pattern: ("-", pattern))
+parser.add_argument('--profile')
+parser.add_argument('--tree-cache', type=int, default=4096)
+parser.add_argument('--stat-cache', action='store_true')
 
 args = parser.parse_args()
 
 args.new_versions = True
+if args.watch:
+    args.incremental = True
+
+if args.command == "diff" and (args.dates is None or len(args.dates) != 2):
+    parser.error("diff needs exactly two --dates")
+
+if args.dates is not None:
+    if args.date_step is not None and len(args.dates) != 2:
+        parser.error("--date-step needs exactly two --dates")
+    args.incremental = True
+    args.new_versions = True
+
+if args.git_out is not None and args.watch:
+    parser.error("--watch cannot be combined with --git-out")
+
 xxxpwd = os.getcwd()
 
+class Tracer:
+    def count(self, counter, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def record(self, phase, repo, start, end):
+        thread = threading.current_thread()
+        with self.lock:
+            self.events.append((phase, repo, start, end, os.getpid(), thread.ident, thread.name))
+
+    def call(self, phase, repo, fn, *fargs):
+        if not self.enabled:
+            return fn(*fargs)
+        start = time.time()
+        try:
+            return fn(*fargs)
+        finally:
+            self.record(phase, repo, start, time.time())
+
+    def take(self):
+        if not self.enabled:
+            return None
+        with self.lock:
+            res = (self.events, self.counters)
+            self.events = []
+            self.counters = {}
+        return res
+
+    def merge(self, trace):
+        if trace is None:
+            return
+        (events, counters) = trace
+        with self.lock:
+            self.events += events
+            for counter in counters:
+                self.counters[counter] = self.counters.get(counter, 0) + counters[counter]
+
+    def summary(self, out):
+        phases = {}
+        repos = {}
+        for (phase, repo, start, end, pid, tid, thread) in self.events:
+            (count, total, longest) = phases.get(phase, (0, 0.0, 0.0))
+            phases[phase] = (count + 1, total + end - start, max(longest, end - start))
+            if repo is not None:
+                repos[repo] = repos.get(repo, 0.0) + end - start
+
+        out.write("%-28s %8s %10s %10s\n" % ("phase", "count", "total", "max"))
+        for phase in sorted(phases, key=lambda phase: -phases[phase][1]):
+            (count, total, longest) = phases[phase]
+            out.write("%-28s %8d %10.3f %10.3f\n" % (phase, count, total, longest))
+
+        out.write("\n%-48s %10s\n" % ("repository", "total"))
+        for repo in sorted(repos, key=lambda repo: -repos[repo])[0:20]:
+            out.write("%-48s %10.3f\n" % (repo or "/", repos[repo]))
+
+        out.write("\n%-28s %10s\n" % ("counter", "value"))
+        for counter in sorted(self.counters):
+            out.write("%-28s %10d\n" % (counter, self.counters[counter]))
+
+    def write_chrome(self, path):
+        res = []
+        threads = set()
+        for (phase, repo, start, end, pid, tid, thread) in self.events:
+            event = {"name": phase, "ph": "X", "pid": pid, "tid": tid,
+                     "ts": int((start - self.start) * 1000000),
+                     "dur": int((end - start) * 1000000)}
+            if repo is not None:
+                event["args"] = {"repo": repo}
+            res.append(event)
+            threads.add((pid, tid, thread))
+        for (pid, tid, thread) in threads:
+            res.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                        "args": {"name": thread}})
+        f = open(path, 'w')
+        json.dump({"traceEvents": res, "displayTimeUnit": "ms"}, f)
+        f.close()
+
+    def report(self):
+        if args.trace:
+            self.summary(sys.stderr)
+        if args.trace_json is not None:
+            self.write_chrome(args.trace_json)
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.events = []
+        self.counters = {}
+
+tracer = Tracer(args.trace or args.trace_json is not None)
+
+created_dirs = set()
+
+def makepath(path):
+    if path in created_dirs:
+        return
+    try:
+        os.makedirs(path)
+        tracer.count("directories created")
+    except OSError:
+        if not os.path.isdir(path):
+            return
+    while path not in ("", "/") and path not in created_dirs:
+        created_dirs.add(path)
+        path = os.path.dirname(path)
+
+def forget_paths(path):
+    for d in list(created_dirs):
+        if d == path or d.startswith(path + "/"):
+            created_dirs.discard(d)
+
+class FsPlan:
+    batch = 1024
+
+    def describe(self, op):
+        if op[0] == "mkdir":
+            return "mkdir -p " + op[1]
+        elif op[0] == "unlink":
+            return "rm -f " + op[1]
+        elif op[0] == "rmtree":
+            return "rm -rf " + op[1]
+        elif op[0] == "symlink":
+            return "ln -s " + op[1] + " " + op[2]
+        elif op[0] == "link":
+            return "ln " + op[1] + " " + op[2]
+        elif op[0] == "copy":
+            return "cp -p " + op[1] + " " + op[2]
+        elif op[0] == "write":
+            return "write " + op[1] + " (" + op[3] + ")"
+        elif op[0] == "rename":
+            return "mv " + op[1] + " " + op[2]
+        elif op[0] == "clone":
+            return "cp -al " + op[1] + " " + op[2]
+        elif op[0] == "chmod":
+            return "chmod %o %s" % (op[2], op[1])
+
+    def do_mkdir(self, path):
+        makepath(path)
+
+    def do_unlink(self, path):
+        if os.path.isfile(path) or os.path.islink(path):
+            os.unlink(path)
+
+    def do_rmtree(self, path):
+        if os.path.islink(path):
+            os.unlink(path)
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+        forget_paths(path)
+
+    def do_symlink(self, target, name):
+        try:
+            os.symlink(target, name)
+            tracer.count("symlinks created")
+        except OSError:
+            pass
+
+    def do_link(self, target, name):
+        self.do_unlink(name)
+        try:
+            os.link(target, name)
+            tracer.count("files linked")
+        except OSError:
+            self.do_copy(target, name)
+
+    def do_copy(self, target, name):
+        self.do_unlink(name)
+        shutil.copy2(target, name)
+        tracer.count("files created")
+        tracer.count("bytes written", os.path.getsize(name))
+
+    def do_write(self, name, fn, desc):
+        self.do_unlink(name)
+        f = open(name, 'wb')
+        try:
+            fn(f)
+            tracer.count("files created")
+            tracer.count("bytes written", f.tell())
+        except:
+            f.close()
+            os.unlink(name)
+            raise
+        f.close()
+
+    def do_rename(self, src, dst):
+        os.rename(src, dst)
+
+    def do_chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def do_clone(self, src, dst):
+        self.do_rmtree(dst)
+        stack = [""]
+        while len(stack) > 0:
+            path = stack.pop()
+            makepath(os.path.join(dst, path))
+            for name, itemtype in scan_directory(os.path.join(src, path)):
+                relpath = os.path.join(path, name)
+                if itemtype == "dir":
+                    stack.append(relpath)
+                elif itemtype == "link":
+                    os.symlink(os.readlink(os.path.join(src, relpath)), os.path.join(dst, relpath))
+                elif itemtype == "file":
+                    self.do_link(os.path.join(src, relpath), os.path.join(dst, relpath))
+
+    def ops(self):
+        try:
+            return self.local.ops
+        except AttributeError:
+            self.local.ops = []
+            return self.local.ops
+
+    def add(self, *op):
+        ops = self.ops()
+        ops.append(op)
+        if len(ops) >= self.batch:
+            self.flush()
+
+    def flush(self):
+        ops = self.ops()
+        self.local.ops = []
+        for op in ops:
+            if self.dry_run:
+                if op[0] == "mkdir":
+                    if op[1] in self.planned:
+                        continue
+                    self.planned.add(op[1])
+                print(self.describe(op))
+            else:
+                getattr(self, "do_" + op[0])(*op[1:])
+
+    def makepath(self, path):
+        self.add("mkdir", path.rstrip("/"))
+
+    def unlink(self, path):
+        self.add("unlink", path)
+
+    def rmtree(self, path):
+        self.add("rmtree", path)
+
+    def symlink(self, target, name):
+        self.add("mkdir", os.path.dirname(name))
+        self.add("symlink", target, name)
+
+    def link(self, target, name):
+        self.add("mkdir", os.path.dirname(name))
+        self.add("link", target, name)
+
+    def copy(self, target, name):
+        self.add("mkdir", os.path.dirname(name))
+        self.add("copy", target, name)
+
+    def write(self, name, fn, desc):
+        self.add("mkdir", os.path.dirname(name))
+        self.add("write", name, fn, desc)
+
+    def rename(self, src, dst):
+        self.add("rename", src, dst)
+
+    def clone(self, src, dst):
+        self.add("clone", src, dst)
+
+    def chmod(self, path, mode):
+        self.add("chmod", path, mode)
+
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.planned = set()
+        self.local = threading.local()
+
+fs = FsPlan(args.dry_run)
+
+def scan_directory(path):
+    if scandir is not None:
+        for entry in scandir(path):
+            if entry.is_symlink():
+                yield (entry.name, "link")
+            elif entry.is_file():
+                yield (entry.name, "file")
+            elif entry.is_dir():
+                yield (entry.name, "dir")
+        return
+
+    for name in os.listdir(path):
+        try:
+            mode = os.lstat(os.path.join(path, name)).st_mode
+        except OSError:
+            continue
+        if S_ISLNK(mode):
+            yield (name, "link")
+        elif S_ISREG(mode):
+            yield (name, "file")
+        elif S_ISDIR(mode):
+            yield (name, "dir")
+
+class Profile:
+    def match(self, pattern, components):
+        if len(components) < len(pattern):
+            return False
+        for (glob, name) in zip(pattern, components):
+            if not fnmatchcase(name, glob):
+                return False
+        return True
+
+    def partial(self, pattern, components):
+        if len(components) >= len(pattern):
+            return False
+        for (glob, name) in zip(pattern, components):
+            if not fnmatchcase(name, glob):
+                return False
+        return True
+
+    def selected(self, path):
+        if not self.active:
+            return True
+        components = path.split("/") if path != "" else []
+        res = self.default
+        for (include, pattern) in self.patterns:
+            if self.match(pattern, components):
+                res = include
+        return res
+
+    def needed(self, path):
+        if self.selected(path):
+            return True
+        components = path.split("/") if path != "" else []
+        for (include, pattern) in self.patterns:
+            if include and self.partial(pattern, components):
+                return True
+        return False
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.patterns = [(sign == "+", pattern.strip("/").split("/")) for (sign, pattern) in spec]
+        self.default = not any(include for (include, pattern) in self.patterns)
+        self.active = len(self.patterns) > 0
+
+def read_profile(path):
+    res = []
+    f = open(path)
+    for line in f.read().split("\n"):
+        line = line.strip()
+        if line == "" or line.startswith("#"):
+            continue
+        if line[0] in "-!":
+            res.append(("-", line[1:].strip()))
+        elif line[0] == "+":
+            res.append(("+", line[1:].strip()))
+        else:
+            res.append(("+", line))
+    f.close()
+    return res
+
+profile = Profile((read_profile(args.profile) if args.profile is not None else []) +
+                  (args.patterns or []))
+
+class StatCache:
+    def path(self, name):
+        return os.path.join(xxxoutdir, "stat-cache", name + ".stat")
+
+    def load(self, name):
+        try:
+            f = open(self.path(name), 'rb')
+        except IOError:
+            return None
+        try:
+            return pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        finally:
+            f.close()
+
+    def save(self, name, key, paths):
+        if args.dry_run:
+            return
+        makepath(os.path.dirname(self.path(name)))
+        tmp = "%s.tmp.%d.%d" % (self.path(name), os.getpid(), threading.current_thread().ident)
+        f = open(tmp, 'wb')
+        pickle.dump((key, paths), f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(tmp, self.path(name))
+
+stat_cache = StatCache()
+
 def delete_old_file(name):
-    if os.path.isfile(name) or os.path.islink(name):
-        os.system("rm " + name)
+    fs.unlink(name)
 
 def symlink_relative(target, name):
-    makepath(os.path.dirname(name))
     relpath = os.path.relpath(target, os.path.dirname(name))
-    try:
-        os.symlink(relpath, name)
-    except OSError:
-        pass
+    fs.symlink(relpath, name)
 
 def symlink_absolute(target, name):
-    makepath(os.path.dirname(name))
-
-    try:
-        os.symlink(target, name)
-    except OSError:
-        pass
+    fs.symlink(target, name)
 
 def copy_or_hardlink(target, name):
-    makepath(os.path.dirname(name))
-    shutil.copy2(target, name)
+    if args.hardlink:
+        fs.link(target, name)
+    else:
+        fs.copy(target, name)
+
+def blob_cache_path(oid):
+    return os.path.join(xxxoutdir, "objects", oid[0:2], oid[2:])
+
+def remove_overlay_path(outdir, path):
+    name = os.path.join(outdir, path)
+    parent = os.path.realpath(os.path.dirname(name))
+    top = os.path.realpath(outdir)
+    if parent != top and not parent.startswith(top + "/"):
+        return
+    if os.path.islink(name) or os.path.isfile(name):
+        fs.unlink(name)
+    elif os.path.isdir(name):
+        fs.rmtree(name)
+
+class Error(Exception):
+    pass
+
+popen_lock = threading.Lock()
+
+def popen(args, **kwargs):
+    with popen_lock:
+        return subprocess.Popen(args, close_fds=True, **kwargs)
+
+class GitSession:
+    memoized = ("log", "rev-parse")
+
+    def batch(self):
+        if self.proc is None:
+            tracer.count("subprocesses")
+            self.proc = popen(["git", "cat-file", "--batch"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                              stderr=open(os.devnull, "w"),
+                              cwd=self.gitpath)
+        return self.proc
+
+    def start(self):
+        with self.lock:
+            if not self.closed:
+                self.batch()
+                return
+        git_sessions.get(self.gitpath).start()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            if self.proc is not None:
+                self.proc.stdin.close()
+                self.proc.wait()
+                self.proc = None
+
+    def invalidate(self):
+        with self.lock:
+            self.memo = {}
+
+    def copy_blob(self, rev, f):
+        with self.lock:
+            if not self.closed:
+                return self.copy_batch_blob(rev, f)
+        git_sessions.get(self.gitpath).copy_blob(rev, f)
+
+    def copy_batch_blob(self, rev, f):
+        proc = self.batch()
+        proc.stdin.write(rev + "\n")
+        proc.stdin.flush()
+        header = proc.stdout.readline().rstrip("\n").split(" ")
+        if len(header) != 3:
+            raise Error("cannot read object " + rev + " in " + self.gitpath)
+        tracer.count("objects read")
+        size = int(header[2])
+        while size > 0:
+            data = proc.stdout.read(min(size, 65536))
+            if data == "":
+                proc.kill()
+                proc.wait()
+                self.proc = None
+                raise Error("short read of object " + rev + " in " + self.gitpath)
+            f.write(data)
+            size -= len(data)
+        proc.stdout.read(1)
+
+    def cat_file(self, rev):
+        with self.lock:
+            if not self.closed:
+                return self.cat_batch_file(rev)
+        return git_sessions.get(self.gitpath).cat_file(rev)
+
+    def cat_batch_file(self, rev):
+        proc = self.batch()
+        proc.stdin.write(rev + "\n")
+        proc.stdin.flush()
+        header = proc.stdout.readline().rstrip("\n").split(" ")
+        if len(header) != 3:
+            return (None, None, None)
+        (sha, objtype, size) = header
+        tracer.count("objects read")
+        data = proc.stdout.read(int(size))
+        proc.stdout.read(1)
+        return (sha, objtype, data)
+
+    def run(self, args):
+        key = tuple(args)
+        with self.lock:
+            if key in self.memo:
+                return self.memo[key]
+        tracer.count("subprocesses")
+        proc = popen(["git"] + args,
+                     stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                     cwd=self.gitpath)
+        (out, err) = proc.communicate()
+        if args[0] in self.memoized:
+            with self.lock:
+                self.memo[key] = out
+        return out
 
-def makepath(path):
+    def git(self, *args):
+        if len(args) == 2 and args[0] == "rev-parse" and not args[1].startswith("-"):
+            (sha, objtype, data) = self.cat_file(args[1])
+            if sha is None:
+                return args[1]
+            return sha
+        return self.run(list(args)).rstrip()
+
+    def gitz(self, *args):
+        res = self.run(list(args) + ["-z"]).split("\0")
+        res.pop()
+        return res
+
+    def __init__(self, gitpath):
+        self.gitpath = gitpath
+        self.lock = threading.Lock()
+        self.proc = None
+        self.closed = False
+        self.memo = {}
+
+class GitSessionPool:
+    def get(self, gitpath):
+        evict = []
+        with self.lock:
+            try:
+                session = self.sessions.pop(gitpath)
+            except KeyError:
+                session = GitSession(gitpath)
+            self.sessions[gitpath] = session
+
+            while len(self.sessions) > self.size:
+                evict.append(self.sessions.popitem(last=False)[1])
+
+        for old in evict:
+            old.close()
+        return session
+
+    def close(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+            self.sessions = OrderedDict()
+        for session in sessions:
+            session.close()
+
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+git_sessions = GitSessionPool(args.git_sessions)
+atexit.register(git_sessions.close)
+
+class CommitGraph:
+    def commit(self, rev):
+        try:
+            obj = self.repository.revparse_single(rev)
+            return obj.peel(pygit2.Commit).hex
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+
+    def parents(self, commit):
+        with self.lock:
+            try:
+                return self.cache[commit]
+            except KeyError:
+                pass
+        res = [oid.hex for oid in self.repository[commit].parent_ids]
+        with self.lock:
+            self.cache[commit] = res
+        return res
+
+    def is_ancestor(self, ancestor, commit):
+        key = (ancestor, commit)
+        with self.lock:
+            if key in self.ancestry:
+                return self.ancestry[key]
+
+        res = False
+        seen = set([commit])
+        l = deque([commit])
+        while len(l) > 0:
+            c = l.popleft()
+            if c == ancestor:
+                res = True
+                break
+            for p in self.parents(c):
+                if p not in seen:
+                    seen.add(p)
+                    l.append(p)
+
+        with self.lock:
+            self.ancestry[key] = res
+        return res
+
+    def descendants(self, commit, tips):
+        reaches = {commit: True}
+        stack = [(tip, False) for tip in tips]
+        while len(stack) > 0:
+            (c, expanded) = stack.pop()
+            if c in reaches:
+                continue
+            parents = self.parents(c)
+            if expanded:
+                reaches[c] = any(reaches.get(p, False) for p in parents)
+                continue
+            stack.append((c, True))
+            for p in parents:
+                if p not in reaches:
+                    stack.append((p, False))
+
+        return set(c for c in reaches if reaches[c] and c != commit)
+
+    def __init__(self, repository):
+        self.repository = repository
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.ancestry = {}
+
+date_timestamps = {}
+
+def date_timestamp(date):
+    if isinstance(date, int):
+        return date
     try:
-        os.makedirs(path)
-    except:
+        return date_timestamps[date]
+    except KeyError:
         pass
 
+    out = backtick(xxxpwd + "/.repo/manifests", "git", "rev-parse", "--until=" + date)
+    ts = int(stripprefix(out, "--min-age="))
+    date_timestamps[date] = ts
+    return ts
+
+pygit2_repositories = {}
+pygit2_lock = threading.Lock()
+
+def pygit2_repository(path):
+    with pygit2_lock:
+        try:
+            return pygit2_repositories[path]
+        except KeyError:
+            r = pygit2.Repository(path)
+            pygit2_repositories[path] = r
+            return r
+
+class DateIndex:
+    def load(self):
+        self.tip = None
+        self.commits = []
+        self.times = []
+        try:
+            f = open(self.path)
+        except IOError:
+            return
+        lines = f.read().split("\n")
+        f.close()
+        if len(lines) == 0 or not lines[0].startswith("tip "):
+            return
+        self.tip = lines[0][4:]
+        for line in lines[1:]:
+            if line == "":
+                continue
+            (commit, when) = line.split(" ")
+            self.commits.append(commit)
+            self.times.append(int(when))
+
+    def save(self):
+        if args.dry_run:
+            return
+        makepath(os.path.dirname(self.path))
+        tmp = self.path + ".tmp." + str(os.getpid())
+        f = open(tmp, 'wb')
+        f.write("tip " + self.tip + "\n")
+        for commit, when in zip(self.commits, self.times):
+            f.write(commit + " " + str(when) + "\n")
+        f.close()
+        os.rename(tmp, self.path)
+
+    def update(self):
+        try:
+            tip = self.repository.revparse_single("HEAD").peel(pygit2.Commit)
+        except (KeyError, pygit2.GitError):
+            return
+        if tip.hex == self.tip:
+            return
+
+        commits = []
+        times = []
+        walker = self.repository.walk(tip.id, pygit2.GIT_SORT_NONE)
+        walker.simplify_first_parent()
+        found = False
+        for commit in walker:
+            if commit.hex == self.tip:
+                found = True
+                break
+            commits.append(commit.hex)
+            times.append(commit.commit_time)
+
+        if found:
+            commits += self.commits
+            times += self.times
+        self.tip = tip.hex
+        self.commits = commits
+        self.times = times
+        self.save()
+
+    def index(self):
+        negmin = []
+        m = None
+        for when in self.times:
+            if m is None or when < m:
+                m = when
+            negmin.append(-m)
+        self.negmin = negmin
+
+    def reset(self):
+        with self.lock:
+            self.negmin = None
+
+    def lookup(self, timestamp):
+        with self.lock:
+            if self.negmin is None:
+                self.load()
+                self.update()
+                self.index()
+            i = bisect.bisect_left(self.negmin, -timestamp)
+            if i == len(self.commits):
+                return None
+            return self.commits[i]
+
+    def __init__(self, repository, name):
+        self.repository = repository
+        self.path = os.path.join(xxxoutdir, "date-index", name + ".index")
+        self.lock = threading.Lock()
+        self.negmin = None
+
+date_indexes = {}
+date_indexes_lock = threading.Lock()
+
+def date_index(repository, name):
+    with date_indexes_lock:
+        try:
+            return date_indexes[name]
+        except KeyError:
+            index = DateIndex(repository, name)
+            date_indexes[name] = index
+            return index
+
+class TreeCache:
+    def tree(self, repository, oid):
+        key = oid.hex
+        with self.lock:
+            try:
+                tree = self.trees.pop(key)
+                self.trees[key] = tree
+                return tree
+            except KeyError:
+                pass
+        tree = repository[oid]
+        tracer.count("objects read")
+        with self.lock:
+            self.trees[key] = tree
+            while len(self.trees) > self.size:
+                self.trees.popitem(last=False)
+        return tree
+
+    def __init__(self, size):
+        self.size = size
+        self.trees = OrderedDict()
+        self.lock = threading.Lock()
+
+tree_cache = TreeCache(args.tree_cache)
+
+def filemode_type(filemode):
+    if filemode == pygit2.GIT_FILEMODE_TREE:
+        return "dir"
+    if filemode == pygit2.GIT_FILEMODE_LINK:
+        return "link"
+    if filemode in (pygit2.GIT_FILEMODE_BLOB, pygit2.GIT_FILEMODE_BLOB_EXECUTABLE):
+        return "file"
+    return None
+
+def diff_changes(*diffs):
+    old = {}
+    new = {}
+    for diff in diffs:
+        for delta in diff.deltas:
+            path = delta.new_file.path
+            if path not in old:
+                old[path] = delta.old_file.mode
+            new[path] = delta.new_file.mode
+
+    res = []
+    for path in sorted(old):
+        if old[path] == 0 and new[path] == 0:
+            continue
+        if old[path] == 0:
+            status = "A"
+        elif new[path] == 0:
+            status = "D"
+        elif filemode_type(old[path]) != filemode_type(new[path]):
+            status = "T"
+        else:
+            status = "M"
+        res.append((status, path, old[path]))
+    return res
+
 class RoRepository:
+    def snapshot_key(self, paths):
+        return tuple(paths)
+
     def master(self):
         try:
             path = xxxoutdir + "/repos-by-name/" + self.name + "/repo"
+            if path in repo_links:
+                return repo_links[path]
             master = os.readlink(path)
 
             return os.path.join(os.path.dirname(path), master)
@@ -68,21 +935,15 @@ class RoRepository:
             return ""
 
 class RoGitRepository(RoRepository):
+    @property
+    def session(self):
+        return git_sessions.get(self.gitpath)
+
     def git(self, *args):
-        proc = subprocess.Popen(["git"] + [arg for arg in args],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                cwd=self.gitpath)
-        (out, err) = proc.communicate()
-        return out.rstrip()
+        return self.session.git(*args)
 
     def gitz(self, *args):
-        proc = subprocess.Popen(["git"] + [arg for arg in args] + ["-z"],
-                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                                cwd=self.gitpath)
-        (out, err) = proc.communicate()
-        res = out.split("\0")
-        res.pop()
-        return res
+        return self.session.gitz(*args)
 
     def revparse(self, head):
         ret = self.git("rev-parse", head)
@@ -94,23 +955,23 @@ class RoGitRepository(RoRepository):
         return ret
 
     def git_parents(self, commit):
-        i = 1
-        res = []
-        while True:
-            p = self.revparse(commit + "^" + str(i))
-            if p is None:
-                break
-            res.append(p)
-            i = i + 1
+        c = self.commitgraph.commit(commit)
+        if c is None:
+            return []
+        return self.commitgraph.parents(c)
 
-        return res
+    def is_ancestor(self, ancestor, commit):
+        a = self.commitgraph.commit(ancestor)
+        c = self.commitgraph.commit(commit)
+        if a is None or c is None:
+            return False
+        return self.commitgraph.is_ancestor(a, c)
 
     def head(self):
-        branch = self.git("log", "-1", "--first-parent", "--reverse", "--pretty=tformat:%H", "--until=" + self.date)
-        branch = branch[0:40]
+        branch = date_index(self.pygit2repository, self.name).lookup(date_timestamp(self.date))
 
         if args.new_versions:
-            head = self.revparse(branch)
+            head = branch
         else:
             head = self.version
 
@@ -128,21 +989,69 @@ class RoGitRepository(RoRepository):
     @property
     def pygit2tree(self):
         if self._pygit2tree is None:
-            r = self.pygit2repository
-            head = r[self.head()]
-            while isinstance(head, pygit2.Reference):
-                head = head.target
-
-            self._pygit2tree = head.tree
+            self._pygit2tree = self.pygit2repository.revparse_single(self.head()).peel(pygit2.Tree)
+            tracer.count("objects read")
         return self._pygit2tree
 
+    def worktree_changes(self):
+        r = self.pygit2repository
+        tree = self.pygit2tree
+        index = r.index
+        index.read(False)
+        return diff_changes(tree.diff_to_index(index), index.diff_to_workdir())
+
+    def head_changes(self):
+        r = self.pygit2repository
+        old = r.revparse_single(self.oldhead).peel(pygit2.Tree)
+        new = r.revparse_single(self.newhead).peel(pygit2.Tree)
+        tracer.count("objects read")
+        return diff_changes(old.diff_to_tree(new))
+
+    def tree_entry(self, file):
+        try:
+            return self.entries[file]
+        except KeyError:
+            pass
+        tree = self.pygit2tree
+        components = file.split("/")
+        path = ""
+        for name in components[:-1]:
+            path = os.path.join(path, name)
+            try:
+                (oid, filemode) = self.entries[path]
+            except KeyError:
+                entry = tree[name]
+                (oid, filemode) = (entry.id, entry.filemode)
+                self.entries[path] = (oid, filemode)
+            tree = tree_cache.tree(self.pygit2repository, oid)
+        entry = tree[components[-1]]
+        res = (entry.id, entry.filemode)
+        self.entries[file] = res
+        return res
+
     @property
     def pygit2repository(self):
         if self._pygit2repository is None:
-            self._pygit2repository = pygit2.Repository(self.gitpath)
+            self._pygit2repository = pygit2_repository(self.gitpath)
 
         return self._pygit2repository
 
+    @property
+    def commitgraph(self):
+        if self._commitgraph is None:
+            self._commitgraph = CommitGraph(self.pygit2repository)
+
+        return self._commitgraph
+
+    def snapshot_key(self, paths):
+        return (getattr(self, "newhead", None),) + tuple(paths)
+
+    def invalidate(self):
+        self.session.invalidate()
+        self._pygit2tree = None
+        self.entries = {}
+        date_index(self.pygit2repository, self.name).reset()
+
     def __init__(self, path, name, url, gitpath, date, version):
         self.relpath = path
         self.name = name
@@ -153,32 +1062,36 @@ class RoGitRepository(RoRepository):
 
         self._pygit2tree = None
         self._pygit2repository = None
+        self._commitgraph = None
+        self._nested = None
+        self.entries = {}
 
 class RoGitRepositoryHead(RoGitRepository):
+    def changed_items(self, changes):
+        res = []
+        for (status, path, filemode) in changes:
+            itempath = os.path.join(self.relpath, path)
+            if status == "A":
+                res.append((os.path.dirname(itempath), None))
+            else:
+                res.append((itempath, filemode_type(filemode)))
+        return res
+
     def find_changed(self, dirstate):
         res = []
         if self.master() == "":
             return res
 
         if not self.master().startswith(xxxpwd + "/"):
-            res.append(os.path.dirname(self.relpath))
+            res.append((os.path.dirname(self.relpath), None))
 
-        l = deque(self.gitz("diff", self.head(), "--name-status"))
-        while len(l) > 0:
-            stat = l.popleft()
-            path = l.popleft()
-
-            res.append(os.path.join(self.relpath, path))
+        self.head()
+        res += self.changed_items(self.worktree_changes())
 
         if self.oldhead == self.newhead:
             return res
 
-        l = deque(self.gitz("diff", self.oldhead + ".." + self.newhead, "--name-status"))
-        while len(l) > 0:
-            stat = l.popleft()
-            path = l.popleft()
-
-            res.append(os.path.join(self.relpath, path))
+        res += self.changed_items(self.head_changes())
 
         return res
 
@@ -198,10 +1111,11 @@ class RoGitRepositoryHead(RoGitRepository):
             filemode = "{0:06o}".format(entry.filemode)
             filemode = filemode[0:3]
             itempath = os.path.join(path, entry.name)
+            self.entries[itempath[len(self.relpath) + 1:]] = (entry.id, entry.filemode)
             if filemode == "040":
                 res += [[itempath, "dir"]]
                 if dirstate.changed(itempath):
-                    res += self.find_siblings_and_types(dirstate, itempath, self.pygit2repository[entry.id])
+                    res += self.find_siblings_and_types(dirstate, itempath, tree_cache.tree(self.pygit2repository, entry.id))
             elif filemode == "120":
                 res += [[itempath, "link"]]
             elif filemode == "100":
@@ -211,96 +1125,195 @@ class RoGitRepositoryHead(RoGitRepository):
 
         return res
 
+    def write_blob(self, oid, dst):
+        session = self.session
+        fs.write(dst, lambda f: session.copy_blob(oid, f), "blob " + oid)
+
     def create_file(self, file, dst):
-        makepath(os.path.dirname(dst))
-        tree = self.pygit2tree
-        oid = tree[file].id
-        blob = self.pygit2repository[oid]
+        (oid, filemode) = self.tree_entry(file)
+        oid = oid.hex
+        executable = filemode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE
+
+        if args.hardlink:
+            cached = blob_cache_path(oid)
+            if executable:
+                cached += ".x"
+            if not os.path.exists(cached):
+                tmp = "%s.tmp.%d.%d" % (cached, os.getpid(), threading.current_thread().ident)
+                self.write_blob(oid, tmp)
+                if executable:
+                    fs.chmod(tmp, 0o755)
+                fs.rename(tmp, cached)
+            fs.link(cached, dst)
+            return
 
-        delete_old_file(dst)
-        f = open(dst, 'wb')
-        f.write(blob.data)
+        self.write_blob(oid, dst)
+        if executable:
+            fs.chmod(dst, 0o755)
 
     def create_link(self, file, dst):
-        makepath(os.path.dirname(dst))
-
-        tree = self.pygit2tree
-        oid = tree[file].id
+        oid = self.tree_entry(file)[0]
         blob = self.pygit2repository[oid]
+        tracer.count("objects read")
 
         delete_old_file(dst)
         symlink_absolute(blob.data, dst)
 
-class RoGitRepositoryHeadNew(RoGitRepositoryHead):
-    def head(self):
-        head = super(RoGitRepositoryHeadNew, self).head()
-
-        if not xxxapply is None:
-            if head in self.git_parents(xxxapply):
-                newhead = xxxapply
-                apply_success += 1
+class RoGitRepositoryWD(RoGitRepository):
+    def snapshot_key(self, paths):
+        res = []
+        for path in paths:
+            try:
+                st = os.lstat(os.path.join(xxxpwd, path))
+                res.append((path, st.st_mtime, st.st_size))
+            except OSError:
+                res.append((path, None, None))
+        return (getattr(self, "newhead", None),) + tuple(res)
+
+    def worktree_base(self):
+        r = self.pygit2repository
+        res = ""
+        try:
+            res += r.head.target.hex
+        except (KeyError, pygit2.GitError):
+            pass
+        for name in ("index", "info/exclude"):
+            try:
+                st = os.stat(os.path.join(r.path, name))
+                res += " %s %r %r %d" % (name, st.st_mtime, st.st_ctime, st.st_size)
+            except OSError:
+                pass
+        return res
 
-        if not xxxdo_emancipate:
-            head = newhead
+    def worktree_stat(self):
+        nested = self.nested_repos()
+        outpath = os.path.join(xxxpwd, "out")
+        start = time.time()
+        base = self.worktree_base()
+        stats = []
+        stack = [self.relpath]
+        while len(stack) > 0:
+            path = stack.pop()
+            top = os.path.join(xxxpwd, path)
+            try:
+                st = os.lstat(top)
+            except OSError:
+                continue
+            if st.st_mtime >= start - 2 or st.st_ctime >= start - 2:
+                return None
+            stats.append((path, st.st_mtime, st.st_ctime))
+            for name, itemtype in scan_directory(top):
+                itempath = os.path.join(path, name)
+                if name == ".gitignore":
+                    try:
+                        st = os.lstat(os.path.join(top, name))
+                    except OSError:
+                        continue
+                    if st.st_mtime >= start - 2 or st.st_ctime >= start - 2:
+                        return None
+                    stats.append((itempath, st.st_mtime, st.st_ctime))
+                if itemtype != "dir" or name == ".git" or itempath in nested:
+                    continue
+                if os.path.join(top, name) == outpath:
+                    continue
+                stack.append(itempath)
+
+        return (base, stats)
+
+    def worktree_unchanged(self, key):
+        (base, stats) = key
+        if base != self.worktree_base():
+            return False
+        for (path, mtime, ctime) in stats:
+            try:
+                st = os.lstat(os.path.join(xxxpwd, path))
+            except OSError:
+                return False
+            if st.st_mtime != mtime or st.st_ctime != ctime:
+                return False
+        return True
+
+    def status_paths(self):
+        worktree_flags = (pygit2.GIT_STATUS_WT_MODIFIED | pygit2.GIT_STATUS_WT_DELETED |
+                          pygit2.GIT_STATUS_WT_TYPECHANGE)
+        if not args.stat_cache:
+            return [path for path, flags in self.pygit2repository.status().items()
+                    if not flags & pygit2.GIT_STATUS_IGNORED]
+
+        cached = stat_cache.load(self.name)
+        if cached is not None and self.worktree_unchanged(cached[0]):
+            index = self.pygit2repository.index
+            index.read(False)
+            paths = set(cached[1])
+            for delta in index.diff_to_workdir().deltas:
+                paths.add(delta.new_file.path)
+            return sorted(paths)
+
+        key = self.worktree_stat()
+        paths = []
+        kept = []
+        for path, flags in self.pygit2repository.status().items():
+            if flags & pygit2.GIT_STATUS_IGNORED:
+                continue
+            paths.append(path)
+            if flags & ~worktree_flags:
+                kept.append(path)
 
-        return head
+        if key is not None:
+            stat_cache.save(self.name, key, kept)
+        return paths
 
-class RoGitRepositoryWD(RoGitRepository):
     def find_changed(self, dirstate):
         res = []
         if not self.master().startswith(xxxpwd + "/"):
-            res.append(os.path.dirname(self.relpath))
+            res.append((os.path.dirname(self.relpath), None))
 
-        l = deque(self.gitz("status"))
-        while len(l) > 0:
-            line = l.popleft()
-            stat = line[0:2]
-            path = line[3:]
+        for path in self.status_paths():
+            res.append((os.path.join(self.relpath, path), None))
 
-            res.append(os.path.join(self.relpath, path))
-
-        if self.oldhead == self.newhead:
+        if getattr(self, "oldhead", None) == getattr(self, "newhead", None):
             return res
 
-        l = deque(self.gitz("diff", self.oldhead + ".." + self.newhead, "--name-status"))
-        while len(l) > 0:
-            stat = l.popleft()
-            path = l.popleft()
-
-            res.append(os.path.join(self.relpath, path))
+        for (status, path, filemode) in self.head_changes():
+            res.append((os.path.join(self.relpath, path), None))
 
         return res
 
+    def nested_repos(self):
+        if self._nested is None:
+            prefix = self.relpath + "/"
+            self._nested = set(repo for repo in list(self.mdata.repos) + self.mdata.excluded
+                               if repo.startswith(prefix))
+        return self._nested
+
+    def walk_worktree(self, dirstate, path):
+        nested = self.nested_repos()
+        outpath = os.path.join(xxxpwd, "out")
+        stack = [path]
+        while len(stack) > 0:
+            path = stack.pop()
+            top = os.path.join(xxxpwd, path)
+            for name, itemtype in scan_directory(top):
+                itempath = os.path.join(path, name)
+                if name == ".git" or itempath in nested:
+                    continue
+                if os.path.join(top, name) == outpath:
+                    continue
+                yield [itempath, itemtype]
+                if itemtype == "dir" and dirstate.changed(itempath):
+                    stack.append(itempath)
+
     def find_siblings_and_types(self, dirstate, path=None):
         if path is None:
             path = self.relpath
 
-        res = []
-        for f in os.listdir(os.path.join(xxxpwd, path)):
-            fullpath = os.path.join(xxxpwd, path, f)
-            if f in self.mdata.repos:
-                continue
-            if f == ".git":
-                continue
-            if (fullpath.startswith(os.path.join(xxxpwd, "out") + "/") or
-                fullpath == os.path.join(xxxpwd, "out")):
-                continue
-            if os.path.islink(fullpath):
-                res.append([os.path.join(path, f), "link"])
-            elif os.path.isfile(fullpath):
-                res.append([os.path.join(path, f), "file"])
-            elif os.path.isdir(fullpath):
-                res.append([os.path.join(path, f), "dir"])
-                if dirstate.changed(os.path.join(path, f)):
-                    res += self.find_siblings_and_types(dirstate, os.path.join(path, f))
-
-        return res
+        return list(self.walk_worktree(dirstate, path))
 
     def create_file(self, file, dst):
-        copy_or_hardlink(file, dst)
+        copy_or_hardlink(os.path.join(xxxpwd, self.relpath, file), dst)
 
     def create_link(self, file, dst):
-        copy_or_hardlink(file, dst)
+        copy_or_hardlink(os.path.join(xxxpwd, self.relpath, file), dst)
 
 
 class RoEmptyRepository(RoRepository):
@@ -314,6 +1327,8 @@ class RoEmptyRepository(RoRepository):
         res = []
         for repo in dirstate.mdata.repos:
             res.append([repo, "dir"])
+        for repo in dirstate.mdata.excluded:
+            res.append([repo, "dir"])
         return res
 
 def stripprefix(string, prefix):
@@ -321,8 +1336,265 @@ def stripprefix(string, prefix):
         return string[len(prefix):]
     raise Error()
 
+class ManifestReader:
+    def resolve_fetch(self, fetch):
+        if "://" in fetch or self.url is None:
+            return fetch
+        (scheme, sep, rest) = self.url.partition("://")
+        if sep == "":
+            return fetch
+        url = urljoin("http://" + rest, fetch)
+        return scheme + "://" + stripprefix(url, "http://")
+
+    def parse(self, data):
+        root = ElementTree.fromstring(data)
+        for node in root:
+            if node.tag == "remote":
+                self.remotes[node.get("name")] = self.resolve_fetch(node.get("fetch", ""))
+            elif node.tag == "default":
+                self.default_remote = node.get("remote", self.default_remote)
+                self.default_revision = node.get("revision", self.default_revision)
+            elif node.tag == "include":
+                self.parse(self.read(node.get("name")))
+            elif node.tag == "project":
+                name = node.get("name")
+                self.projects[node.get("path", name)] = [name, node.get("remote"),
+                                                         node.get("revision"),
+                                                         self.split_groups(node.get("groups", ""))]
+            elif node.tag == "remove-project":
+                name = node.get("name")
+                for path in [path for path in self.projects if self.projects[path][0] == name]:
+                    del self.projects[path]
+            elif node.tag == "extend-project":
+                name = node.get("name")
+                for path in self.projects:
+                    project = self.projects[path]
+                    if project[0] != name or node.get("path", path) != path:
+                        continue
+                    if node.get("remote") is not None:
+                        project[1] = node.get("remote")
+                    if node.get("revision") is not None:
+                        project[2] = node.get("revision")
+                    project[3] += self.split_groups(node.get("groups", ""))
+
+    def split_groups(self, groups):
+        return groups.replace(",", " ").split()
+
+    def manifest_groups(self):
+        try:
+            groups = self.repository.config["manifest.groups"]
+        except KeyError:
+            groups = "default,platform-" + platform.system().lower()
+        return self.split_groups(groups)
+
+    def matches_groups(self, groups, path, name, project_groups):
+        project_groups = ["all", "name:" + name, "path:" + path] + project_groups
+        if "notdefault" not in project_groups:
+            project_groups.append("default")
+        res = False
+        for group in groups:
+            if group.startswith("-") and group[1:] in project_groups:
+                res = False
+            elif group in project_groups:
+                res = True
+        return res
+
+    def read(self, name):
+        entry = self.tree
+        for component in name.split("/"):
+            entry = self.repository[entry[component].id]
+        return entry.data
+
+    def local_manifests(self):
+        res = []
+        local = os.path.join(xxxpwd, ".repo", "local_manifests")
+        try:
+            names = sorted(os.listdir(local))
+        except OSError:
+            return res
+        for name in names:
+            if name.endswith(".xml"):
+                f = open(os.path.join(local, name))
+                res.append(f.read())
+                f.close()
+        return res
+
+    def cache_path(self, key):
+        return os.path.join(xxxoutdir, "manifest-cache", key)
+
+    def load(self, key):
+        try:
+            f = open(self.cache_path(key))
+        except IOError:
+            return None
+        res = []
+        for line in f.read().split("\n"):
+            if line != "":
+                res.append(tuple(line.split(" : ")))
+        f.close()
+        return res
+
+    def save(self, key, projects):
+        if args.dry_run:
+            return
+        makepath(os.path.dirname(self.cache_path(key)))
+        tmp = "%s.tmp.%d" % (self.cache_path(key), os.getpid())
+        f = open(tmp, 'wb')
+        for project in projects:
+            f.write(" : ".join(project) + "\n")
+        f.close()
+        os.rename(tmp, self.cache_path(key))
+
+    def projects_at(self, version):
+        commit = self.repository.revparse_single(version).peel(pygit2.Commit)
+        local = self.local_manifests()
+        groups = self.manifest_groups()
+        key = commit.hex + "-" + hashlib.sha1("\0".join([" ".join(groups)] + local)).hexdigest()[0:12]
+
+        with self.lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        res = self.load(key)
+        if res is None:
+            self.tree = commit.tree
+            self.remotes = {}
+            self.default_remote = None
+            self.default_revision = ""
+            self.projects = OrderedDict()
+            self.parse(self.read("default.xml"))
+            for data in local:
+                self.parse(data)
+
+            res = []
+            for path in self.projects:
+                (name, remote, revision, project_groups) = self.projects[path]
+                if not self.matches_groups(groups, path, name, project_groups):
+                    continue
+                fetch = self.remotes.get(remote or self.default_remote, "")
+                url = fetch.rstrip("/") + "/" + name
+                res.append((path, name, url, revision or self.default_revision))
+            self.save(key, res)
+
+        with self.lock:
+            self.cache[key] = res
+        return res
+
+    def __init__(self, gitpath, url=None):
+        self.repository = pygit2_repository(gitpath)
+        self.url = url
+        self.lock = threading.Lock()
+        self.cache = {}
+
+manifest_reader = None
+
+def read_manifest(version):
+    global manifest_reader
+    if manifest_reader is None:
+        manifest_reader = ManifestReader(os.path.join(xxxpwd, ".repo", "manifests"),
+                                         "git://github.com/Quarx2k/android.git")
+    return manifest_reader.projects_at(version)
+
+def repo_relpath(path, repo):
+    if repo == "":
+        return path
+    if path == repo:
+        return "."
+    return path[len(repo)+1:]
+
+class RepositoryIndex:
+    def chain(self, path):
+        node = self.root
+        repo = node[1]
+        res = [repo]
+        if path == "":
+            return res
+        for name in path.split("/"):
+            if node is not None:
+                node = node[0].get(name)
+                if node is not None and node[1] is not None:
+                    repo = node[1]
+            res.append(repo)
+        return res
+
+    def find(self, path):
+        node = self.root
+        repo = node[1]
+        if path != "":
+            for name in path.split("/"):
+                node = node[0].get(name)
+                if node is None:
+                    break
+                if node[1] is not None:
+                    repo = node[1]
+        return (repo, repo_relpath(path, repo))
+
+    def __init__(self, repos):
+        self.root = [{}, None]
+        for repo in repos:
+            node = self.root
+            if repo != "":
+                for name in repo.split("/"):
+                    node = node[0].setdefault(name, [{}, None])
+            node[1] = repo
+
+class VersionIndex:
+    def line(self, pos):
+        if pos > 0:
+            self.f.seek(pos - 1)
+            self.f.readline()
+        else:
+            self.f.seek(0)
+        return self.f.readline()
+
+    def lookup(self, repo):
+        key = repo + "\t"
+        with self.lock:
+            if self.f is None:
+                try:
+                    self.f = open(self.path, 'rb')
+                except IOError:
+                    return None
+            lo = 0
+            hi = os.fstat(self.f.fileno()).st_size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                line = self.line(mid)
+                if line != "" and line < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            line = self.line(lo)
+        if not line.startswith(key):
+            return None
+        return tuple(line.rstrip("\n").split("\t"))
+
+    def entries(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return []
+        res = [tuple(line.split("\t")) for line in f.read().split("\n") if line != ""]
+        f.close()
+        return res
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = None
+
+def format_versions(entries):
+    lines = []
+    for entry in entries:
+        lines.append("\t".join(field.replace("\t", " ").replace("\n", " ") for field in entry) + "\n")
+    return "".join(sorted(lines))
+
 class ManifestData:
     def read_version(self, repo):
+        entry = self.versions.lookup(repo)
+        if entry is not None:
+            return entry[1]
+
         try:
             f = open(xxxoutdir + "/head/.pipcet-ro/versions/" + repo + "/version.txt")
             (path,sep,info) = f.readlines()[0].partition(": ")
@@ -333,88 +1605,130 @@ class ManifestData:
         return head
 
     def read_versions(self):
-        for dirpath, dirs, files in os.walk(xxxoutdir + "/head/.pipcet-ro/versions"):
-            if "version.txt" in files:
-                f = open(os.path.join(dirpath, "version.txt"))
-                (path,info) = f.readlines()[0].partition(": ")
-                (head,name,url) = info.split(" ")
+        for entry in self.versions.entries():
+            self.version[entry[0]] = entry[1]
 
-                self.version[path] = head
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = RepositoryIndex(self.repos)
+        return self._index
 
     def find_repository(self, path):
-        while True:
-            try:
-                r = self.repos[path]
-                return (r, path)
-            except KeyError:
-                pass
+        (repo, gitpath) = self.index.find(path)
+        return (self.repos[repo], repo, gitpath)
 
-            path = os.path.dirname(path)
+    def repository_chain(self, path):
+        return self.index.chain(path)
 
     def new_repository_class(self):
         return RoGitRepositoryHead
 
     def new_repository(self, repopath, name, url, gitpath, date, version):
-        self.repos[repopath] = self.new_repository_class()(repopath, name, url, gitpath, date, version)
+        r = self.new_repository_class()(repopath, name, url, gitpath, date, version)
+        r.mdata = self
+        self.repos[repopath] = r
+        self._index = None
+
     def __init__(self, version=None, date=None):
         self.version = {}
         self.repos = {}
+        self._index = None
+        self.versions = VersionIndex(xxxoutdir + "/head/.pipcet-ro/versions.index")
+        self.excluded = []
 
         self.date = date
 
         if not version is None:
-            cmd = "echo rm -rf {outdir}/manifests; mkdir -p {outdir}/manifests/{version}/manifests && cp -a {pwd}/.repo/local_manifests {outdir}/manifests/{version}/ && git clone {pwd}/.repo/manifests {outdir}/manifests/{version}/manifests && (cd {outdir}/manifests/{version}/manifests && git checkout {version} && cp -a .git ../manifests.git && ln -s manifests/default.xml ../manifest.xml && git config remote.origin.url git://github.com/Quarx2k/android.git) && (cd {pwd}; python {pwd}/.repo/repo/main.py --wrapper-version=1.21 --repo-dir={outdir}/manifests/{version} -- list --url > {outdir}/manifests/{version}/output)"
-            os.system(cmd.format(pwd=xxxpwd, outdir=xxxoutdir, version=version))
-
-            for line in open(os.path.join(xxxoutdir, "manifests", version, "output")).readlines():
-                (repopath,name,url,branchref) = line.split(" : ")
-                self.new_repository(repopath, name, url, os.path.join(xxxoutdir, "repos-by-name", name, "repo"), date, self.read_version(repopath))
+            for (repopath,name,url,branchref) in read_manifest(version):
+                if not profile.needed(repopath):
+                    self.excluded.append(repopath)
+                    continue
+                if not os.path.exists(os.path.join(xxxpwd, repopath, ".git")):
+                    continue
+                self.new_repository(repopath, name, url, repo_link(os.path.join(xxxoutdir, "repos-by-name", name, "repo")), date, self.read_version(repopath))
 
         repopath = ".repo/repo"
-        self.new_repository(repopath, repopath, "", os.path.join(xxxoutdir, "repos-by-name", repopath, "repo"), date, self.read_version(repopath))
+        self.new_repository(repopath, repopath, "", repo_link(os.path.join(xxxoutdir, "repos-by-name", repopath, "repo")), date, self.read_version(repopath))
 
         repopath = ".repo/manifests"
-        self.new_repository(repopath, repopath, "", os.path.join(xxxoutdir, "repos-by-name", repopath, "repo"), date, self.read_version(repopath))
+        self.new_repository(repopath, repopath, "", repo_link(os.path.join(xxxoutdir, "repos-by-name", repopath, "repo")), date, self.read_version(repopath))
 
         self.repos[""] = RoEmptyRepository()
+        self._index = None
 
 class ManifestDataHead(ManifestData):
     def new_repository_class(self):
         return RoGitRepositoryHead
 
-class ManifestDataHeadNew(ManifestDataHead):
-    def new_repository_class(self):
-        return RoGitRepositoryHeadNew
-
 class ManifestDataWD(ManifestData):
     def new_repository_class(self):
         return RoGitRepositoryWD
 
-    def __init__(self, version=None, date=None):
-        self.version = {}
-        self.repos = {}
-
-        self.date = date
 
-        if not version is None:
-            cmd = "echo rm -rf {outdir}/manifests; mkdir -p {outdir}/manifests/{version}/manifests && cp -a {pwd}/.repo/local_manifests {outdir}/manifests/{version}/ && git clone {pwd}/.repo/manifests {outdir}/manifests/{version}/manifests && (cd {outdir}/manifests/{version}/manifests && git checkout {version} && cp -a .git ../manifests.git && ln -s manifests/default.xml ../manifest.xml && git config remote.origin.url git://github.com/Quarx2k/android.git) && (cd {pwd}; python {pwd}/.repo/repo/main.py --wrapper-version=1.21 --repo-dir={outdir}/manifests/{version} -- list --url > {outdir}/manifests/{version}/output)"
-            os.system(cmd.format(pwd=xxxpwd, outdir=xxxoutdir, version=version))
 
-            for line in open(os.path.join(xxxoutdir, "manifests", version, "output")).readlines():
-                (repopath,name,url,branchref) = line.split(" : ")
-                self.new_repository(repopath, name, url, os.path.join(xxxoutdir, "repos-by-name", name, "repo"), date, self.read_version(repopath))
-        else:
-            pass
+class ItemNode(object):
+    __slots__ = ("children", "itemtype", "changed", "repo")
 
-        repopath = ".repo/repo"
-        self.new_repository(repopath, repopath, "", os.path.join(xxxoutdir, "repos-by-name", repopath, "repo"), date, self.read_version(repopath))
+    def __init__(self):
+        self.children = None
+        self.itemtype = None
+        self.changed = None
+        self.repo = None
 
-        repopath = ".repo/manifests"
-        self.new_repository(repopath, repopath, "", os.path.join(xxxoutdir, "repos-by-name", repopath, "repo"), date, self.read_version(repopath))
+class ItemTrie:
+    def chain(self, path):
+        node = self.root
+        res = [node]
+        if path == "":
+            return res
+        for name in path.split("/"):
+            if node.children is None:
+                node.children = {}
+            try:
+                node = node.children[name]
+            except KeyError:
+                child = ItemNode()
+                node.children[intern(name)] = child
+                node = child
+            res.append(node)
+        return res
 
-        self.repos[""] = RoEmptyRepository()
+    def find(self, path):
+        node = self.root
+        if path != "":
+            for name in path.split("/"):
+                if node.children is None:
+                    return None
+                node = node.children.get(name)
+                if node is None:
+                    return None
+        return node
+
+    def get(self, path):
+        node = self.find(path)
+        if node is None or node.repo is None:
+            return None
+        return node
 
+    def walk(self, path=""):
+        node = self.find(path)
+        if node is None:
+            return
+        stack = [(path, node)]
+        while len(stack) > 0:
+            (path, node) = stack.pop()
+            if node.repo is not None:
+                yield (path, node)
+            if node.children is not None:
+                for name, child in node.children.items():
+                    if path == "":
+                        stack.append((name, child))
+                    else:
+                        stack.append((path + "/" + name, child))
 
+    def __init__(self):
+        self.root = ItemNode()
 
 class Item:
     def __init__(self, path, itemtype=None, changed=None):
@@ -442,9 +1756,8 @@ class Item:
 
         if itemtype == "dir":
             if dirstate.changed(path):
-                makepath(os.path.join(outdir, path))
+                fs.makepath(os.path.join(outdir, path))
             else:
-                makepath(os.path.join(outdir, os.path.dirname(path)))
                 if not os.path.lexists(os.path.join(outdir, path)):
                     if r is not None:
                         target = os.path.join(r.master(), gitpath)
@@ -460,147 +1773,503 @@ class Item:
         elif itemtype == "link":
             r.create_link(gitpath, outdir + "/" + repo + "/" + gitpath)
 
-class DirState:
-    def create_directory(self, outdir):
-        for item in self.items:
-            self.items[item].create(self, outdir)
+class WorkerError:
+    def __init__(self, tb):
+        self.tb = tb
 
-    def snapshot(self, outdir, *arg_repos):
-        repos = arg_repos
-        if len(repos) == 0:
-            repos = self.mdata.repos.keys()
+def run_task(fn, fargs):
+    try:
+        return fn(*fargs)
+    except Exception:
+        return WorkerError(traceback.format_exc())
 
-            os.system("echo rm -rf " + outdir + "/*")
-            os.system("echo rm -rf " + outdir + "/.repo")
-            makepath(outdir)
-
-        lock = threading.Lock()
-        q1 = Queue.Queue()
-        q2 = Queue.Queue()
-
-        def thr_changed(changed):
-            while True:
-                repo = q1.get()
-                lchanged = self.mdata.repos[repo].find_changed(self)
-                with lock:
-                    changed += lchanged
-                q1.task_done()
-
-        def thr_siblings_and_types(types):
-            while True:
-                repo = q2.get()
-                ltypes = self.mdata.repos[repo].find_siblings_and_types(self, repo)
-                with lock:
-                    types += ltypes
-                q2.task_done()
-
-        threads = []
-        changed = []
-        for count in range(128):
-            threads.append(threading.Thread(target=thr_changed, args=[changed]))
-        for t in threads:
-            t.daemon = True
-            t.start()
-        for repo in self.mdata.repos:
-            q1.put(repo)
+class ChangedSet:
+    def changed(self, path):
+        return path in self.paths
+
+    def __init__(self, paths):
+        self.paths = paths
 
-        q1.join()
+scan_mdata = None
 
-        for path in changed:
-            self.store_item(path, Item(path, changed=1))
+def scan_repository(repo, changed):
+    tracer.take()
+    fn = scan_mdata.repos[repo].find_siblings_and_types
+    res = run_task(tracer.call, ("find_siblings_and_types", repo, fn, changed, repo))
+    return (res, tracer.take())
 
-        threads = []
-        types = []
-        for count in range(128):
-            threads.append(threading.Thread(target=thr_siblings_and_types, args=[types]))
-        for t in threads:
+class Scheduler:
+    def worker(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            (tag, fn, fargs) = task
+            self.results.put((tag, run_task(tracer.call, (fn.__name__, tag[1], fn) + fargs)))
+
+    def submit(self, tag, fn, *fargs):
+        self.pending += 1
+        self.tasks.put((tag, fn, fargs))
+
+    def submit_process(self, tag, fn, *fargs):
+        self.pending += 1
+        self.processes.apply_async(fn, fargs,
+                                   callback=lambda res: self.results.put((tag, self.collect(res))))
+
+    def collect(self, res):
+        (res, trace) = res
+        tracer.merge(trace)
+        return res
+
+    def next(self):
+        (tag, res) = self.results.get()
+        self.pending -= 1
+        if isinstance(res, WorkerError):
+            raise RuntimeError("worker failed on " + repr(tag) + ":\n" + res.tb)
+        return (tag, res)
+
+    def close(self):
+        for t in self.threads:
+            self.tasks.put(None)
+        for t in self.threads:
+            t.join()
+        if self.processes is not None:
+            self.processes.close()
+            self.processes.join()
+
+    def __init__(self, jobs, backend):
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.pending = 0
+        self.processes = None
+        if backend == "process":
+            self.processes = multiprocessing.Pool(jobs)
+        self.threads = []
+        for count in range(jobs):
+            t = threading.Thread(target=self.worker, name="worker-%d" % count)
             t.daemon = True
             t.start()
-        for repo in self.mdata.repos:
-            q2.put(repo)
+            self.threads.append(t)
+
+class DirState:
+    def item(self, path, itemtype, changed, repo):
+        item = Item(path, itemtype, changed)
+        item.repo = repo
+        item.r = self.mdata.repos[repo]
+        item.gitpath = repo_relpath(path, repo)
+        item.repopath = path
+        return item
 
-        q2.join()
+    def create_directory(self, outdir):
+        for path, node in self.items.walk():
+            if node.repo in self.streamed_repos and path != node.repo:
+                continue
+            self.item(path, node.itemtype, node.changed, node.repo).create(self, outdir)
+        fs.flush()
 
+    def create_items(self, outdir, types):
+        res = []
         for path, itemtype in types:
-            self.store_item(path, Item(path, itemtype=itemtype))
+            repo = self.mdata.find_repository(path)[1]
+            changed = self.changed(path)
+            self.item(path, itemtype, changed, repo).create(self, outdir)
+            if args.incremental:
+                res.append((repo, path, itemtype, bool(changed)))
+        fs.flush()
+        return res
 
-        self.create_directory(outdir)
+    def update_directory(self, outdir, state, affected):
+        oldchanged = set([""])
+        for repo in state["items"]:
+            for path, (itemtype, changed) in state["items"][repo].items():
+                if changed:
+                    oldchanged.add(path)
+
+        removals = []
+        for repo in affected:
+            for path, (itemtype, changed) in state["items"].get(repo, {}).items():
+                if path == "" or os.path.dirname(path) not in oldchanged:
+                    continue
+                if itemtype == "dir" and changed and self.changed(path):
+                    continue
+                removals.append(path)
+
+        for path in sorted(removals):
+            remove_overlay_path(outdir, path)
+        fs.flush()
+
+        for path, node in self.items.walk():
+            if node.repo in affected:
+                self.item(path, node.itemtype, node.changed, node.repo).create(self, outdir)
+        fs.flush()
+
+    def repo_keys(self):
+        paths = {}
+        for repo in self.mdata.repos:
+            paths[repo] = []
+        for path, item in self.items.walk():
+            if item.changed and item.repo in paths:
+                paths[item.repo].append(path)
 
+        keys = {}
+        for repo in paths:
+            parent = repo == "" or self.changed(os.path.dirname(repo))
+            keys[repo] = (parent,) + self.mdata.repos[repo].snapshot_key(sorted(paths[repo]))
+        return keys
 
-    def changed(self, path):
-        try:
-            return self.items[path].changed
-        except KeyError:
-            return False
+    def state_path(self, outdir):
+        return outdir.rstrip("/") + ".state"
 
-    def store_item(self, path, item):
-        (item.r, item.repo) = self.mdata.find_repository(path)
+    def load_state(self, outdir):
+        try:
+            f = open(self.state_path(outdir), 'rb')
+        except IOError:
+            return None
+        try:
+            state = pickle.load(f)
+        except (EOFError, pickle.UnpicklingError):
+            return None
+        finally:
+            f.close()
+        if state.get("profile", []) != profile.spec:
+            return None
+        return state
+
+    def new_state(self, keys, state, scanned):
+        items = {}
+        if state is not None:
+            for repo in state["items"]:
+                if repo not in scanned and repo in self.mdata.repos:
+                    items[repo] = state["items"][repo]
+        for path, item in self.items.walk():
+            if item.repo not in scanned:
+                continue
+            items.setdefault(item.repo, {})[path] = (item.itemtype, bool(item.changed))
+        for repo, path, itemtype, changed in self.streamed:
+            items.setdefault(repo, {})[path] = (itemtype, changed)
+        return {"keys": keys, "items": items, "profile": profile.spec}
 
-        if not item.r is None:
-            if item.repo != "":
-                item.gitpath = os.path.relpath(path, item.repo)
-            else:
-                item.gitpath = path
+    def save_state(self, outdir):
+        if args.dry_run:
+            return
+        f = open(self.state_path(outdir) + ".tmp", 'wb')
+        pickle.dump(self.state, f, pickle.HIGHEST_PROTOCOL)
+        f.close()
+        os.rename(self.state_path(outdir) + ".tmp", self.state_path(outdir))
 
-        item.repopath = path
+    def parent_repos(self, repo):
+        res = []
+        while repo != "":
+            repo = os.path.dirname(repo)
+            if repo != "" and repo in self.mdata.repos:
+                res.append(repo)
+        return res
 
-        if path in self.items:
-            olditem = self.items[path]
+    def submit_scan(self, scheduler, repo):
+        r = self.mdata.repos[repo]
+        if scheduler.processes is not None and isinstance(r, RoGitRepository):
+            changed = ChangedSet(set(path for path, node in self.items.walk(repo) if node.changed))
+            scheduler.submit_process(("types", repo), scan_repository, repo, changed)
         else:
-            olditem = Item(path)
-            self.items[path] = olditem
+            scheduler.submit(("types", repo), r.find_siblings_and_types, self, repo)
+
+    def drain(self, scheduler, pending):
+        while scheduler.pending > 0:
+            (tag, res) = scheduler.next()
+            (kind, repo) = tag
+            if kind == "created":
+                self.streamed += res
+                continue
+            if kind == "types":
+                if self.stream_to is not None and repo != "":
+                    r = self.mdata.repos[repo]
+                    if isinstance(r, RoGitRepository):
+                        r.session.start()
+                    self.streamed_repos.add(repo)
+                    scheduler.submit(("created", repo), self.create_items, self.stream_to, res)
+                    continue
+                for path, itemtype in res:
+                    self.store_item(path, Item(path, itemtype=itemtype))
+                continue
 
-        for key in item.__dict__:
-            if not item.__dict__[key] is None:
-                olditem.__dict__[key] = item.__dict__[key]
+            self.found_changed[repo] = res
+            for path, itemtype in res:
+                self.store_item(path, Item(path, itemtype=itemtype, changed=1))
+            if pending is None:
+                continue
+            for parent in [repo] + self.parent_repos(repo):
+                pending[parent] -= 1
+                if pending[parent] == 0:
+                    self.submit_scan(scheduler, parent)
 
-        if path == "":
-            return
+    def snapshot(self, outdir, *arg_repos):
+        repos = arg_repos
+        state = None
+        if len(repos) == 0:
+            repos = self.mdata.repos.keys()
 
-        directory = os.path.dirname(path)
+            if self.state is not None:
+                state = self.state
+            elif args.incremental:
+                state = self.load_state(outdir)
+            if state is None:
+                fs.rmtree(outdir)
+            fs.makepath(outdir)
+            fs.flush()
 
-        if (directory in self.items and
-            (self.changed(directory) or not item.changed)):
-            return
+        if args.stream and state is None:
+            self.stream_to = outdir
+
+        global scan_mdata
+        scan_mdata = self.mdata
+        scheduler = Scheduler(max(args.jobs, 1), args.backend)
+
+        pending = {}
+        for repo in self.mdata.repos:
+            pending[repo] = 1
+        for repo in self.mdata.repos:
+            for parent in self.parent_repos(repo):
+                pending[parent] += 1
 
-        diritem = Item(directory)
-        diritem.itemtype = "dir"
-        if item.changed:
-            diritem.changed = True
+        for repo in self.mdata.repos:
+            if repo in self.known_changed:
+                scheduler.submit(("changed", repo), list, self.known_changed[repo])
+            else:
+                scheduler.submit(("changed", repo), self.mdata.repos[repo].find_changed, self)
+
+        scan = list(self.mdata.repos)
+        affected = set(scan)
+        keys = None
+        try:
+            tracer.call("scan", None, self.drain, scheduler, pending if state is None else None)
+
+            if args.incremental:
+                keys = self.repo_keys()
+            if state is not None:
+                affected = set(repo for repo in scan if keys[repo] != state["keys"].get(repo))
+                affected |= set(repo for repo in state["keys"] if repo not in keys)
+                scan = [repo for repo in scan if repo in affected or repo == ""]
+                for repo in scan:
+                    self.submit_scan(scheduler, repo)
+                tracer.call("scan", None, self.drain, scheduler, None)
+        finally:
+            scheduler.close()
+
+        if state is None:
+            tracer.call("create_directory", None, self.create_directory, outdir)
+        else:
+            tracer.call("update_directory", None, self.update_directory, outdir, state, affected)
+
+        for repo in self.mdata.repos:
+            r = self.mdata.repos[repo]
+            if isinstance(r, RoGitRepository):
+                r.entries = {}
 
-        self.store_item(directory, diritem)
+        if keys is not None:
+            self.state = self.new_state(keys, state, set(scan))
+            if self.persist:
+                tracer.call("save_state", None, self.save_state, outdir)
+
+    def changed(self, path):
+        node = self.items.get(path)
+        if node is None:
+            return False
+        return node.changed
+
+    def store_item(self, path, item):
+        if item.changed and not profile.selected(path):
+            return
+        chain = self.items.chain(path)
+        repos = self.mdata.repository_chain(path)
+        node = chain[-1]
+        if node.repo is None:
+            node.repo = repos[-1]
+        if item.itemtype is not None:
+            node.itemtype = item.itemtype
+        if item.changed is not None:
+            node.changed = item.changed
+
+        for i in range(len(chain) - 2, -1, -1):
+            node = chain[i]
+            if (node.repo is not None and
+                (node.changed or not item.changed)):
+                return
+
+            if node.repo is None:
+                node.repo = repos[i]
+            node.itemtype = "dir"
+            if item.changed:
+                node.changed = True
 
     def directory_changed(self, path):
         return self.changed(os.dirname(path))
 
     def __init__(self, mdata):
-        self.items = {"": Item("", changed=True)}
+        self.items = ItemTrie()
+        self.stream_to = None
+        self.streamed = []
+        self.streamed_repos = set()
+        self.known_changed = {}
+        self.found_changed = {}
+        self.state = None
+        self.persist = True
+        self.items.root.repo = ""
+        self.items.root.changed = True
         self.mdata = mdata
 
+class Inotify:
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, self.mask)
+        if wd >= 0:
+            self.watches[wd] = path
+
+    def add_tree(self, path, skip):
+        stack = [path]
+        while len(stack) > 0:
+            path = stack.pop()
+            self.add(path)
+            try:
+                entries = list(scan_directory(path))
+            except OSError:
+                continue
+            for name, itemtype in entries:
+                if itemtype == "dir" and not skip(os.path.join(path, name)):
+                    stack.append(os.path.join(path, name))
+
+    def read(self, timeout):
+        (r, w, x) = select.select([self.fd], [], [], timeout)
+        if len(r) == 0:
+            return
+        data = os.read(self.fd, 65536)
+        i = 0
+        while i + 16 <= len(data):
+            (wd, mask, cookie, length) = struct.unpack_from("iIII", data, i)
+            name = data[i + 16:i + 16 + length].rstrip("\0")
+            i += 16 + length
+            path = self.watches.get(wd)
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            yield (path, name, mask)
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.watches = {}
+
+def watch_skip(mdata, path):
+    relpath = os.path.relpath(path, xxxpwd)
+    if os.path.basename(relpath) == ".git":
+        return True
+    if relpath == "out" or relpath in mdata.repos or relpath in mdata.excluded:
+        return True
+    return False
+
+def watch_repository(inotify, mdata, r):
+    top = os.path.join(xxxpwd, r.relpath)
+    inotify.add_tree(top, lambda path: watch_skip(mdata, path))
+    inotify.add(os.path.join(top, ".git"))
+    inotify.add_tree(os.path.join(top, ".git", "refs"), lambda path: False)
+
+def watch(mdata, dirstate, outdir):
+    inotify = Inotify()
+    for repo in mdata.repos:
+        r = mdata.repos[repo]
+        if isinstance(r, RoGitRepository):
+            watch_repository(inotify, mdata, r)
+
+    try:
+        os.unlink(dirstate.state_path(outdir))
+    except OSError:
+        pass
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    dirty = {}
+    try:
+        while True:
+            for path, name, mask in inotify.read(args.watch_delay):
+                if path is None or mask & Inotify.IN_Q_OVERFLOW:
+                    for repo in mdata.repos:
+                        dirty[repo] = time.time()
+                    continue
+                fullpath = os.path.join(path, name)
+                repo = mdata.find_repository(os.path.relpath(fullpath, xxxpwd))[1]
+                dirty[repo] = time.time()
+                if (mask & Inotify.IN_ISDIR and mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO) and
+                    not watch_skip(mdata, fullpath)):
+                    inotify.add_tree(fullpath, lambda path: watch_skip(mdata, path))
+
+            now = time.time()
+            ready = [repo for repo in dirty if now - dirty[repo] >= args.watch_delay]
+            if len(ready) == 0:
+                continue
+
+            known = dict(dirstate.found_changed)
+            for repo in ready:
+                del dirty[repo]
+                known.pop(repo, None)
+                r = mdata.repos[repo]
+                if isinstance(r, RoGitRepository):
+                    r.invalidate()
+
+            new = DirState(mdata)
+            new.known_changed = known
+            new.state = dirstate.state
+            new.persist = False
+            new.snapshot(outdir)
+            dirstate = new
+    finally:
+        dirstate.save_state(outdir)
+
 def path_prefixes(path):
     res = []
     while path != "":
         path = os.path.dirname(path)
         res.append(path)
-    return res.reverse()
+    res.reverse()
+    return res
 
 def delete_repository(outdir, repo):
     prefixes = path_prefixes(repo)
 
     for prefix in prefixes:
         if os.path.islink(os.path.join(outdir, prefix)):
-            os.system("echo rm " + os.path.join(outdir, prefix))
+            fs.unlink(os.path.join(outdir, prefix))
+            fs.flush()
             return
 
-    if os.path.islink(os.path.join(outdir, repo)):
-        os.system("echo rm " + os.path.join(outdir, repo))
-    else:
-        os.system("echo rm -r " + os.path.join(outdir, repo))
+    fs.rmtree(os.path.join(outdir, repo))
+    fs.flush()
+
+repo_links = {}
+
+def repo_link(path):
+    if args.dry_run:
+        return repo_links.get(path, path)
+    return path
 
 def setup_repo_links():
-    os.system("echo rm -rf " + xxxoutdir + "/repos-by-name")
+    links = FsPlan(args.dry_run)
 
-    head_mdata = ManifestDataHeadNew(version = "HEAD")
+    head_mdata = ManifestDataHead(version = "HEAD")
 
     for repo in head_mdata.repos:
         r = head_mdata.repos[repo]
@@ -609,8 +2278,9 @@ def setup_repo_links():
 
         name = r.name
         linkdir = os.path.join(xxxoutdir, "repos-by-name", name)
-        symlink_absolute(os.path.join(xxxpwd, r.relpath),
-                         os.path.join(linkdir, "repo"))
+        links.symlink(os.path.join(xxxpwd, r.relpath),
+                      os.path.join(linkdir, "repo"))
+        repo_links[os.path.join(linkdir, "repo")] = os.path.join(xxxpwd, r.relpath)
 
     other_repos = []
     for path, dirs, files in os.walk(os.path.join(xxxoutdir, "other-repositories")):
@@ -621,58 +2291,596 @@ def setup_repo_links():
         name=stripprefix(repo, os.path.join(xxxoutdir, "other-repositories")+"/")
         linkdir=os.path.join(xxxoutdir, "repos-by-name", name)
 
-        makepath(linkdir)
-        symlink_absolute(os.path.join(xxxoutdir, "other-repositories", name),
-                         os.path.join(linkdir, "repo"))
+        links.symlink(os.path.join(xxxoutdir, "other-repositories", name),
+                      os.path.join(linkdir, "repo"))
+        repo_links[os.path.join(linkdir, "repo")] = os.path.join(xxxoutdir, "other-repositories", name)
+
+    links.flush()
+
+def format_log(commit):
+    lines = ["commit " + commit.hex]
+    if len(commit.parent_ids) > 1:
+        lines.append("Merge: " + " ".join(oid.hex[0:7] for oid in commit.parent_ids))
+    author = commit.author
+    offset = author.offset
+    sign = "+"
+    if offset < 0:
+        sign = "-"
+    when = time.gmtime(author.time + offset * 60)
+    lines.append("Author: " + author.raw_name + " <" + author.raw_email + ">")
+    lines.append("Date:   " + time.strftime("%a %b ", when) + str(when.tm_mday) +
+                 time.strftime(" %H:%M:%S %Y", when) +
+                 " %s%02d%02d" % (sign, abs(offset) // 60, abs(offset) % 60))
+    lines.append("")
+    for line in commit.raw_message.rstrip("\n").split("\n"):
+        lines.append("    " + line)
+    return "\n".join(lines)
+
+def version_entry(repo, r, logs):
+    head = ""
+    when = ""
+    subject = ""
+    log = ""
+    try:
+        head = getattr(r, "newhead", None) or r.head()
+        commit = r.pygit2repository.revparse_single(head).peel(pygit2.Commit)
+        tracer.count("objects read")
+        when = str(commit.commit_time)
+        subject = commit.raw_message.split("\n")[0]
+        if logs:
+            log = format_log(commit)
+    except Exception:
+        pass
+    return ((repo, head, r.name, r.url, when, subject), log)
 
-def write_versions(mdata):
+def version_entries(mdata, logs=False):
+    scheduler = Scheduler(max(args.jobs, 1), "thread")
     for repo in mdata.repos:
         r = mdata.repos[repo]
         if isinstance(r, RoEmptyRepository):
             continue
-        head = ""
-        name = r.name
-        url = r.url
+        scheduler.submit(("version", repo), version_entry, repo, r, logs)
+
+    entries = []
+    try:
+        while scheduler.pending > 0:
+            entries.append(scheduler.next()[1])
+    finally:
+        scheduler.close()
+    return entries
+
+def write_versions(mdata, outdir):
+    entries = version_entries(mdata, args.version_files)
+    index = format_versions([entry for (entry, log) in entries])
+    fs.write(os.path.join(outdir, ".pipcet-ro", "versions.index"),
+             lambda f: f.write(index), "versions index")
+
+    fs.rmtree(os.path.join(outdir, ".pipcet-ro", "versions"))
+    if args.version_files:
+        for ((repo, head, name, url, when, subject), log) in entries:
+            text = repo + "/: " + head + " " + name + " " + url + "\n# " + "\n# ".join(log.split("\n")) + "\n"
+            fs.write(os.path.join(outdir, ".pipcet-ro", "versions", repo, "version.txt"),
+                     lambda f, text=text: f.write(text), "version")
+    fs.flush()
+
+class OverlayRepository:
+    def base(self, r, gitpath):
         try:
-            head = r.head()
-        except:
+            tree = r.pygit2tree
+            if gitpath == ".":
+                return tree.id
+            entry = tree[gitpath]
+        except (KeyError, ValueError, pygit2.GitError):
+            return None
+        if entry.filemode != pygit2.GIT_FILEMODE_TREE:
+            return None
+        return entry.id
+
+    def tree(self, path):
+        overrides = []
+        for name in sorted(self.children.get(path, ())):
+            overrides.append((name, self.tree(os.path.join(path, name))))
+        overrides = tuple(overrides)
+
+        (repo, gitpath) = self.mdata.index.find(path)
+        r = self.mdata.repos[repo]
+        base = None
+        if isinstance(r, RoGitRepository):
+            base = self.base(r, gitpath)
+        key = (base, overrides)
+        if key in self.memo:
+            return self.memo[key]
+
+        if base is None:
+            builder = self.repository.TreeBuilder()
+        else:
+            builder = self.repository.TreeBuilder(self.repository[base])
+        for name, oid in overrides:
+            builder.insert(name, oid, pygit2.GIT_FILEMODE_TREE)
+        oid = builder.write()
+        self.memo[key] = oid
+        return oid
+
+    def alternates(self, mdata):
+        path = os.path.join(self.path, "objects", "info", "alternates")
+        try:
+            f = open(path)
+            res = set(line for line in f.read().split("\n") if line != "")
+            f.close()
+        except IOError:
+            res = set()
+        old = set(res)
+        for repo in mdata.repos:
+            r = mdata.repos[repo]
+            if not isinstance(r, RoGitRepository):
+                continue
+            try:
+                res.add(os.path.realpath(os.path.join(r.pygit2repository.path, "objects")))
+            except (KeyError, pygit2.GitError):
+                continue
+        if res != old:
+            makepath(os.path.dirname(path))
+            f = open(path, 'w')
+            f.write("".join(line + "\n" for line in sorted(res)))
+            f.close()
+            self.repository = pygit2.Repository(self.path)
+            self.memo = {}
+
+    def commit(self, mdata, date, message):
+        self.alternates(mdata)
+        self.mdata = mdata
+        self.children = {}
+        for repo in mdata.repos:
+            while repo != "":
+                (parent, name) = os.path.split(repo)
+                self.children.setdefault(parent, set()).add(name)
+                repo = parent
+
+        builder = self.repository.TreeBuilder(self.repository[self.tree("")])
+        pipcet = self.repository.TreeBuilder()
+        index = format_versions([entry for (entry, log) in version_entries(mdata)])
+        pipcet.insert("versions.index", self.repository.create_blob(index), pygit2.GIT_FILEMODE_BLOB)
+        builder.insert(".pipcet-ro", pipcet.write(), pygit2.GIT_FILEMODE_TREE)
+        tree = builder.write()
+
+        parents = []
+        try:
+            parent = self.repository.revparse_single(args.git_ref).peel(pygit2.Commit)
+            if parent.tree.id == tree:
+                return parent.id
+            parents = [parent.id]
+        except KeyError:
             pass
+
+        timestamp = date_timestamp(date)
+        signature = pygit2.Signature("repo-overlay", "repo-overlay@localhost", timestamp, 0)
+        return self.repository.create_commit(args.git_ref, signature, signature, message, tree, parents)
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.isdir(path):
+            pygit2.init_repository(path, True)
+        self.repository = pygit2.Repository(path)
+        self.memo = {}
+        self.mdata = None
+        self.children = {}
+
+def worktree_oid(path):
+    try:
+        mode = os.lstat(path).st_mode
+    except OSError:
+        return None
+    if S_ISLNK(mode):
+        return pygit2.hash(os.readlink(path))
+    if S_ISREG(mode):
+        return pygit2.hashfile(path)
+    return None
+
+def overlay_changes(repository, rev):
+    commit = repository.revparse_single(rev).peel(pygit2.Commit)
+    if len(commit.parents) > 0:
+        diff = repository.diff(commit.parents[0], commit)
+    else:
+        diff = commit.tree.diff_to_tree(swap=True)
+
+    res = []
+    for delta in diff.deltas:
+        if delta.status_char() == "A":
+            old = None
+        else:
+            old = delta.old_file.id
+        if delta.status_char() == "D":
+            res.append((delta.old_file.path, old, None, None))
+        else:
+            res.append((delta.new_file.path, old, delta.new_file.id, delta.new_file.mode))
+    return res
+
+def overlay_heads(repository, rev):
+    commit = repository.revparse_single(rev).peel(pygit2.Commit)
+    if len(commit.parents) == 0:
+        return {}
+    try:
+        entry = commit.parents[0].tree[".pipcet-ro/versions.index"]
+    except KeyError:
+        return {}
+
+    res = {}
+    for line in repository[entry.id].data.split("\n"):
+        fields = line.split("\t")
+        if len(fields) > 1 and fields[1] != "":
+            res[fields[0]] = fields[1]
+    return res
+
+def check_slice(r, changes, base):
+    errors = []
+    if base is not None and not r.is_ancestor(base, "HEAD"):
+        errors.append(r.relpath + ": HEAD does not descend from " + base)
+    for (gitpath, old, new, mode) in changes:
+        if worktree_oid(os.path.join(r.master(), gitpath)) != old:
+            errors.append(os.path.join(r.relpath, gitpath) + ": working tree does not match the commit's parent")
+    return errors
+
+def prepare_slice(repository, r, changes):
+    res = []
+    try:
+        for (gitpath, old, new, mode) in changes:
+            dst = os.path.join(r.master(), gitpath)
+            if new is None:
+                res.append((None, dst))
+                continue
+            tmp = "%s.tmp.%d" % (dst, os.getpid())
+            res.append((tmp, dst))
+            data = repository[new].data
+            if mode == pygit2.GIT_FILEMODE_LINK:
+                fs.symlink(data, tmp)
+            else:
+                fs.write(tmp, lambda f, data=data: f.write(data), "blob " + new.hex)
+                if mode == pygit2.GIT_FILEMODE_BLOB_EXECUTABLE:
+                    fs.chmod(tmp, 0o755)
+        fs.flush()
+    except Exception:
+        fs.local.ops = []
+        for (tmp, dst) in res:
+            if tmp is not None and os.path.lexists(tmp):
+                os.unlink(tmp)
+        raise
+    return res
+
+def apply_overlay(rev):
+    path = args.git_out
+    if path is None:
+        path = pygit2.discover_repository(os.path.join(xxxoutdir, "head-py"))
+    repository = pygit2.Repository(path)
+
+    mdata = ManifestData(version=args.apply_use_manifest or "HEAD")
+    heads = overlay_heads(repository, rev)
+    slices = {}
+    errors = []
+    for (path, old, new, mode) in overlay_changes(repository, rev):
+        if path == ".pipcet-ro" or path.startswith(".pipcet-ro/"):
+            continue
+        (r, repo, gitpath) = mdata.find_repository(path)
+        if not isinstance(r, RoGitRepository):
+            errors.append(path + ": not inside any repository")
+        elif args.apply_repo is not None and repo != args.apply_repo.strip("/"):
+            errors.append(path + ": outside of " + args.apply_repo)
+        else:
+            slices.setdefault(repo, []).append((gitpath, old, new, mode))
+
+    scheduler = Scheduler(max(args.jobs, 1), "thread")
+    try:
+        for repo in slices:
+            scheduler.submit(("check", repo), check_slice, mdata.repos[repo], slices[repo], heads.get(repo))
+        while scheduler.pending > 0:
+            errors += scheduler.next()[1]
+        if len(errors) > 0:
+            sys.stderr.write("cannot apply " + rev + ":\n" + "".join(error + "\n" for error in sorted(errors)))
+            sys.exit(1)
+
+        prepared = []
+        failed = None
+        for repo in slices:
+            scheduler.submit(("prepare", repo), prepare_slice, repository, mdata.repos[repo], slices[repo])
+        while scheduler.pending > 0:
+            try:
+                prepared += scheduler.next()[1]
+            except RuntimeError as e:
+                failed = e
+    finally:
+        scheduler.close()
+
+    if failed is not None:
+        for (tmp, dst) in prepared:
+            if tmp is not None:
+                fs.unlink(tmp)
+        fs.flush()
+        raise failed
+
+    for (tmp, dst) in prepared:
+        if tmp is None:
+            fs.unlink(dst)
+        else:
+            fs.rename(tmp, dst)
+    fs.flush()
+
+    for repo in sorted(slices):
+        print(repo + ": " + str(len(slices[repo])) + " change(s)")
+
+def format_date(timestamp, offset):
+    sign = "+"
+    if offset < 0:
+        sign = "-"
+    return (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(timestamp + offset * 60)) +
+            " %s%02d%02d" % (sign, abs(offset) // 60, abs(offset) % 60))
+
+def prefix_patch(data, prefix):
+    res = []
+    for line in data.split("\n"):
+        if line.startswith("@@"):
+            res.append(line)
+            break
+        if line.startswith("diff --git a/"):
+            (old, sep, new) = line[len("diff --git a/"):].partition(" b/")
+            line = "diff --git a/" + prefix + old + " b/" + prefix + new
+        elif line.startswith("--- a/") or line.startswith("+++ b/"):
+            line = line[0:6] + prefix + line[6:]
+        elif (line.startswith("rename from ") or line.startswith("rename to ") or
+              line.startswith("copy from ") or line.startswith("copy to ")):
+            (verb, direction, path) = line.split(" ", 2)
+            line = verb + " " + direction + " " + prefix + path
+        elif line.startswith("Binary files "):
+            line = line.replace(" a/", " a/" + prefix, 1).replace(" b/", " b/" + prefix, 1)
+        res.append(line)
+    return "\n".join(res + data.split("\n")[len(res):])
+
+def write_log_entry(out, repo, repository, commit):
+    date = format_date(commit.commit_time, commit.commit_time_offset)
+    lines = commit.raw_message.rstrip("\n").split("\n")
+    out.write("* " + repo + "/ " + commit.hex[0:7] + " by " + commit.author.raw_name + " at " + date + "\n")
+    out.write("..CommitDate:" + date + "\n")
+    out.write("..SHA:" + commit.hex + "\n")
+    out.write(".." + lines[0] + "\n")
+    for line in lines[1:]:
+        if line != "":
+            line = "      " + line
+        out.write(line + "\n")
+    out.write("\n")
+
+    if not args.patch:
+        return
+    if len(commit.parents) > 0:
+        diff = repository.diff(commit.parents[0], commit)
+    else:
+        diff = commit.tree.diff_to_tree(swap=True)
+    for patch in diff:
+        out.write(prefix_patch(patch.data, repo + "/"))
+
+def log_push(heap, stream, since):
+    (seq, repo, repository, walker) = stream
+    try:
+        commit = next(walker)
+    except StopIteration:
+        return
+    if since is not None and commit.commit_time < since:
+        return
+    heapq.heappush(heap, (-commit.commit_time, seq, commit, stream))
+
+def forest_log(mdata, since, out):
+    heap = []
+    for repo in sorted(mdata.repos):
+        if not isinstance(mdata.repos[repo], RoGitRepository):
+            continue
         try:
-            comment = r.git("log", "-1", head)
-        except:
-            comment = ""
-        comment = "# "+"\n# ".join(comment.split("\n"))
-        makepath(os.path.join(xxxoutdir, "head-py", ".pipcet-ro", "versions", repo))
+            repository = pygit2_repository(os.path.join(xxxpwd, repo))
+            walker = repository.walk(repository.head.target, pygit2.GIT_SORT_TIME)
+        except (KeyError, ValueError, pygit2.GitError):
+            continue
+        walker.simplify_first_parent()
+        log_push(heap, (len(heap), repo, repository, walker), since)
 
-        f = open(os.path.join(xxxoutdir, "head-py", ".pipcet-ro", "versions", repo, "version.txt"), 'wb')
-        f.write(repo + "/: " + head + " " + name + " " + url + "\n" + comment + "\n")
-        f.close()
+    while len(heap) > 0:
+        (key, seq, commit, stream) = heapq.heappop(heap)
+        write_log_entry(out, stream[1], stream[2], commit)
+        log_push(heap, stream, since)
+
+def manifest_point(point):
+    manifests = pygit2_repository(xxxpwd + "/.repo/manifests")
+    try:
+        commit = manifests.revparse_single(point).peel(pygit2.Commit)
+        return (commit.hex, commit.commit_time)
+    except (KeyError, ValueError, pygit2.GitError):
+        pass
+    date = date_timestamp(point)
+    return (date_index(manifests, ".repo/manifests").lookup(date), date)
+
+def repository_tree(r):
+    if r is None:
+        return None
+    try:
+        return r.pygit2tree
+    except (KeyError, ValueError, pygit2.GitError):
+        return None
+
+def diff_pairs(old, new):
+    def repos(mdata):
+        return [repo for repo in mdata.repos if isinstance(mdata.repos[repo], RoGitRepository)]
+
+    removed = {}
+    for repo in repos(old):
+        r = new.repos.get(repo)
+        if r is None or r.name != old.repos[repo].name:
+            removed[old.repos[repo].name] = repo
+
+    res = []
+    for repo in repos(new):
+        r = new.repos[repo]
+        if repo in old.repos and old.repos[repo].name == r.name:
+            res.append((repo, old.repos[repo], repo, r))
+        elif r.name in removed:
+            oldrepo = removed.pop(r.name)
+            res.append((oldrepo, old.repos[oldrepo], repo, r))
+        else:
+            res.append((None, None, repo, r))
+    for oldrepo in removed.values():
+        res.append((oldrepo, old.repos[oldrepo], None, None))
+    return sorted(res, key=lambda pair: pair[2] or pair[0])
+
+def diff_pair(oldrepo, oldr, newrepo, newr):
+    oldtree = repository_tree(oldr)
+    newtree = repository_tree(newr)
+    tracer.count("objects read")
+    res = []
+    if oldtree is None and newtree is None:
+        return res
+    if oldtree is not None and newtree is not None and oldrepo != newrepo and not args.patch:
+        res.append("R\t" + oldrepo + "/\t" + newrepo + "/\n")
+    if oldtree is None:
+        diff = newtree.diff_to_tree(swap=True)
+    elif newtree is None:
+        diff = oldtree.diff_to_tree()
+    elif oldtree.id == newtree.id:
+        return res
+    else:
+        diff = oldtree.diff_to_tree(newtree, flags=pygit2.GIT_DIFF_INCLUDE_TYPECHANGE)
+
+    prefix = (newrepo or oldrepo) + "/"
+    if not args.patch:
+        for delta in diff.deltas:
+            path = prefix + delta.new_file.path
+            if profile.selected(path):
+                res.append(delta.status_char() + "\t" + path + "\n")
+        return res
+    for patch in diff:
+        if profile.selected(prefix + patch.delta.new_file.path):
+            res.append(prefix_patch(patch.data, prefix))
+    return res
+
+def forest_diff(old, new, out):
+    pairs = diff_pairs(old, new)
+    order = deque()
+    scheduler = Scheduler(max(args.jobs, 1), "thread")
+    for pair in pairs:
+        repo = pair[2] or pair[0]
+        order.append(repo)
+        scheduler.submit(("diff", repo), diff_pair, *pair)
+
+    done = {}
+    try:
+        while scheduler.pending > 0:
+            (tag, res) = scheduler.next()
+            done[tag[1]] = res
+            while len(order) > 0 and order[0] in done:
+                out.write("".join(done.pop(order.popleft())))
+    finally:
+        scheduler.close()
+
+def date_points(dates, step):
+    if step is None:
+        return [(date.replace("/", "_"), date) for date in dates]
+    res = []
+    (start, end) = [date_timestamp(date) for date in dates]
+    while start <= end:
+        res.append((time.strftime("%Y-%m-%d", time.gmtime(start)), start))
+        start += step * 86400
+    return res
+
+def snapshot_dates(points, overlay):
+    manifests = pygit2_repository(xxxpwd + "/.repo/manifests")
+    prev = None
+    prevdir = None
+    for (label, date) in points:
+        outdir = os.path.join(xxxoutdir, "dates", label)
+        version = date_index(manifests, ".repo/manifests").lookup(date_timestamp(date))
+        mdata = tracer.call("ManifestData", None, ManifestData, version, date)
+        if overlay is not None:
+            commit = tracer.call("commit", None, overlay.commit, mdata, date, "overlay at " + label + "\n")
+            print(label + " " + commit.hex)
+            continue
+        dirstate = DirState(mdata)
+        dirstate.state = dirstate.load_state(outdir)
+        if dirstate.state is None and prev is not None:
+            for repo in mdata.repos:
+                r = mdata.repos[repo]
+                old = prev.mdata.repos.get(repo)
+                if (isinstance(r, RoGitRepository) and old.__class__ is r.__class__ and
+                    old.gitpath == r.gitpath and repo in prev.found_changed and
+                    getattr(old, "newhead", None) == r.head()):
+                    dirstate.known_changed[repo] = prev.found_changed[repo]
+            fs.clone(prevdir, outdir)
+            tracer.call("clone", None, fs.flush)
+            dirstate.state = prev.state
+        tracer.call("snapshot", None, dirstate.snapshot, outdir)
+        tracer.call("write_versions", None, write_versions, mdata, outdir)
+        prev = dirstate
+        prevdir = outdir
 
 def backtick(cwd, *args):
-    proc = subprocess.Popen([arg for arg in args],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                            cwd=cwd)
+    tracer.count("subprocesses")
+    proc = popen([arg for arg in args],
+                 stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                 cwd=cwd)
     (out, err) = proc.communicate()
     return out.rstrip()
 
-xxxoutdir = "/home/pip/tmp-repo-overlay"
+xxxoutdir = args.out if args.out is not None else "/home/pip/tmp-repo-overlay"
 
 date = "March.1"
 
-setup_repo_links()
+def main():
+    if tracer.enabled:
+        atexit.register(tracer.report)
+
+    if args.command == "log":
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        since = None
+        if args.since is not None:
+            since = date_timestamp(args.since)
+        out = sys.stdout
+        if args.patch:
+            out.write(" -*- mode: Diff; eval: (orgstruct++-mode 1); -*-\n")
+        forest_log(ManifestData(version="HEAD"), since, out)
+        return
+
+    if args.command == "diff":
+        signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+        tracer.call("setup_repo_links", None, setup_repo_links)
+        (old, new) = [tracer.call("ManifestData", None, ManifestData, *manifest_point(point))
+                      for point in args.dates]
+        tracer.call("diff", None, forest_diff, old, new, sys.stdout)
+        return
+
+    tracer.call("setup_repo_links", None, setup_repo_links)
+
+    if args.apply is not None:
+        apply_overlay(args.apply)
+        return
+
+    overlay = None
+    if args.git_out is not None:
+        overlay = OverlayRepository(args.git_out)
+
+    if args.dates is not None:
+        snapshot_dates(date_points(args.dates, args.date_step), overlay)
+    else:
+        if args.new_versions:
+            manifest_head = date_index(pygit2_repository(xxxpwd + "/.repo/manifests"), ".repo/manifests").lookup(date_timestamp(date))
+        else:
+            manifest_head = ManifestData().read_version(".repo/manifests")
+
+        mdata_head = tracer.call("ManifestData", None, ManifestData, manifest_head, date)
+        if overlay is not None:
+            commit = tracer.call("commit", None, overlay.commit, mdata_head, date, "overlay at " + date + "\n")
+            print(commit.hex)
+            return
 
-if args.new_versions:
-    os.system("echo rm -rf " + xxxoutdir + "/head/.pipcet-ro/versions/*")
-    os.system("rm -rf " + xxxoutdir + "/head-py")
+        dirstate_head = DirState(mdata_head)
 
-if args.new_versions:
-    manifest_head = backtick(xxxpwd + "/.repo/manifests", "git", "log", "-1", "--first-parent", "--pretty=tformat:%H", "--until='" + date + "'")
-else:
-    manifest_head = ManifestData().read_version(".repo/manifests")
+        tracer.call("snapshot", None, dirstate_head.snapshot, xxxoutdir + "/head-py")
 
-mdata_head = ManifestData(version=manifest_head, date=date)
-dirstate_head = DirState(mdata_head)
+        tracer.call("write_versions", None, write_versions, mdata_head, xxxoutdir + "/head-py")
 
-dirstate_head.snapshot("/home/pip/tmp-repo-overlay/head-py")
+        if args.watch:
+            watch(mdata_head, dirstate_head, xxxoutdir + "/head-py")
 
-write_versions(mdata_head)
+if __name__ == "__main__":
+    main()